@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Compares pages/sec of links extraction engines on HTML pages from WARC file or on synthetic pages
+
+Usage: python benchmarks/bench_links.py [file.warc.gz] [--pages N] [--repeat N]
+"""
+import argparse
+import time
+
+from warcio import ArchiveIterator
+
+from metawarc.cmds.links import LINK_EXTRACTORS, get_link_extractor
+
+
+def warc_pages(filename:str, limit:int):
+    """Returns list of HTML payloads of response records"""
+    pages = []
+    with open(filename, 'rb') as fh:
+        for record in ArchiveIterator(fh):
+            if record.rec_type != 'response' or record.http_headers is None:
+                continue
+            content_type = record.http_headers.get_header('content-type', '')
+            if not content_type.startswith('text/html'):
+                continue
+            pages.append(record.content_stream().read())
+            if len(pages) >= limit:
+                break
+    return pages
+
+
+def synthetic_pages(limit:int):
+    """Returns list of generated HTML pages with links, nested markup and text"""
+    pages = []
+    for n in range(limit):
+        parts = ['<html><head><title>Page %d</title></head><body><div class="content">' % n]
+        for i in range(200):
+            parts.append('<p>Paragraph %d with <b>bold</b> text and <a href="/page/%d/%d" class="nav item" id="l%d">link <span>%d</span></a></p>' % (i, n, i, i, i))
+        parts.append('</div></body></html>')
+        pages.append(''.join(parts).encode('utf8'))
+    return pages
+
+
+def bench(engine:str, pages:list, repeat:int):
+    """Returns pages per second and number of links extracted"""
+    extractor = get_link_extractor(engine)
+    links = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            links += len(extractor.extract(page))
+    elapsed = time.perf_counter() - start
+    return len(pages) * repeat / elapsed, links // repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Links extraction engines benchmark')
+    parser.add_argument('warcfile', nargs='?', default=None, help='WARC file with HTML pages, synthetic pages used if not set')
+    parser.add_argument('--pages', type=int, default=500, help='Max number of pages')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of passes over pages')
+    args = parser.parse_args()
+    pages = warc_pages(args.warcfile, args.pages) if args.warcfile else synthetic_pages(args.pages)
+    total = sum(len(page) for page in pages)
+    print('%d pages, %0.2f MB' % (len(pages), total / 1048576.0))
+    for engine in LINK_EXTRACTORS.keys():
+        speed, links = bench(engine, pages, args.repeat)
+        print('%-5s %10.1f pages/sec %8d links' % (engine, speed, links))
+
+
+if __name__ == '__main__':
+    main()
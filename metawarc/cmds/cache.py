@@ -0,0 +1,117 @@
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+
+from .shards import copy_stream
+
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Part of cache size left after eviction, so directory not scanned on each write to full cache
+CACHE_LOW_WATERMARK = 0.9
+
+
+class ContentCache:
+    """On disk cache of decoded payloads keyed by warc_id. Modification time of cached file used as last access time,
+    least recently used payloads removed when cache grows larger than max size. Cache directory could be shared by
+    several processes and runs, hits and misses counted by each instance"""
+
+    def __init__(self, directory:str, max_size:int=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key:str):
+        digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key:str):
+        """Returns opened cached payload or None if it's not cached. Access time of payload updated.
+        Opened payload could be read even if it's evicted by other thread or process"""
+        path = self.path(key)
+        try:
+            fh = open(path, 'rb')
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return fh
+
+    def put(self, key:str, stream):
+        """Writes payload stream to cache. Returns opened cached payload"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tempname = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                written = copy_stream(stream, f)
+            fh = open(tempname, 'rb')
+            os.replace(tempname, path)
+        except BaseException:
+            os.remove(tempname)
+            raise
+        with self.lock:
+            if self.size is None:
+                self.size = sum([size for mtime, size, name in self.entries()])
+            else:
+                self.size += written
+            if self.size > self.max_size:
+                self.evict(keep=path)
+        return fh
+
+    def fetch(self, key:str, open_stream):
+        """Returns opened cached payload. On miss payload read from stream returned by open_stream and cached"""
+        fh = self.get(key)
+        if fh is None:
+            fh = self.put(key, open_stream())
+        return fh
+
+    def entries(self):
+        """Returns list of cached payloads as tuples of access time, size and path"""
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    # removed by other process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        return entries
+
+    def evict(self, keep:str=None):
+        """Removes least recently used payloads until cache size is below low watermark. Payload just written kept"""
+        entries = sorted(self.entries())
+        total = sum([size for mtime, size, name in entries])
+        for mtime, size, name in entries:
+            if total <= self.max_size * CACHE_LOW_WATERMARK:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(name)
+            except OSError:
+                # removed by other process or opened on systems not allowing to remove opened files
+                pass
+            total -= size
+        logging.debug('Cache %s evicted to %d bytes' % (self.directory, total))
+        self.size = total
+
+    def stats(self):
+        """Returns human readable hits and misses statistics"""
+        total = self.hits + self.misses
+        return 'cache hits %d, misses %d, hit ratio %0.1f%%' % (self.hits, self.misses, 100.0 * self.hits / total if total > 0 else 0)
@@ -0,0 +1,225 @@
+import os
+import hashlib
+
+from .dataset import table_exists
+
+
+CHECKSUM_BLOCK_SIZE = 65536
+
+
+def parquet_scan(paths:list, hive_partitioning:bool=False):
+    """Returns DuckDB table function reading list of parquet files or glob patterns as single table, columns matched by name.
+    Partition columns of hive partitioned paths added only if hive_partitioning set"""
+    prep_paths = ','.join(["'" + path.replace("'", "''") + "'" for path in paths])
+    return f"read_parquet([{prep_paths}], union_by_name=true, hive_partitioning={str(hive_partitioning).lower()})"
+
+
+def ensure_catalog(con):
+    """Creates files and tables catalog if not exists. Tables catalog keyed by WARC file and table type,
+    so several WARC files could share one compacted parquet file. Catalog keyed by path migrated in one transaction"""
+    glob_tables = [x[0] for x in con.sql('show tables').fetchall()]
+    if 'files' not in glob_tables:
+        con.sql("CREATE TABLE files (filename VARCHAR PRIMARY KEY,filesize BIGINT, num_records INTEGER, mtime DOUBLE, checksum VARCHAR);")
+    else:
+        con.sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS mtime DOUBLE;")
+        con.sql("ALTER TABLE files ADD COLUMN IF NOT EXISTS checksum VARCHAR;")
+    if 'tables' not in glob_tables:
+        con.sql("CREATE TABLE tables (warcfile VARCHAR, path VARCHAR, type VARCHAR, num_items INTEGER, PRIMARY KEY (warcfile, type));")
+        return
+    keys = con.sql("select constraint_column_names from duckdb_constraints() where table_name = 'tables' and constraint_type = 'PRIMARY KEY'").fetchall()
+    if len(keys) > 0 and list(keys[0][0]) == ['warcfile', 'type']:
+        return
+    con.begin()
+    con.sql("CREATE TABLE tables_new (warcfile VARCHAR, path VARCHAR, type VARCHAR, num_items INTEGER, PRIMARY KEY (warcfile, type));")
+    con.sql("INSERT OR REPLACE INTO tables_new SELECT warcfile, path, type, num_items FROM tables")
+    con.sql("DROP TABLE tables")
+    con.sql("ALTER TABLE tables_new RENAME TO tables")
+    con.commit()
+
+
+def file_checksum(filename:str, filesize:int):
+    """Returns fast checksum of file calculated from it's size, first and last blocks"""
+    checksum = hashlib.sha1(str(filesize).encode('utf8'))
+    with open(filename, 'rb') as fh:
+        checksum.update(fh.read(CHECKSUM_BLOCK_SIZE))
+        if filesize > CHECKSUM_BLOCK_SIZE:
+            fh.seek(max(CHECKSUM_BLOCK_SIZE, filesize - CHECKSUM_BLOCK_SIZE))
+            checksum.update(fh.read(CHECKSUM_BLOCK_SIZE))
+    return checksum.hexdigest()
+
+
+def file_fingerprint(filename:str, checksum:bool=False):
+    """Returns size, modification time and optionally checksum of WARC file"""
+    stat = os.stat(filename)
+    fingerprint = {'filesize' : stat.st_size, 'mtime' : stat.st_mtime, 'checksum' : None}
+    if checksum:
+        fingerprint['checksum'] = file_checksum(filename, stat.st_size)
+    return fingerprint
+
+
+def exclude_sources(con, path:str, sources:list):
+    """Rewrites shared parquet file without rows of WARC files"""
+    tempname = path + '.tmp'
+    prep_sources = ','.join(["'" + source.replace("'", "''") + "'" for source in sources])
+    prep_temp = tempname.replace("'", "''")
+    con.sql(f"COPY (SELECT * FROM {parquet_scan([path])} WHERE source NOT IN ({prep_sources})) TO '{prep_temp}' (FORMAT parquet, COMPRESSION zstd)")
+    os.replace(tempname, path)
+
+
+def release_shared(con, list_tables:list):
+    """Removes rows of reindexed WARC files from compacted files they share with other WARC files,
+    so rows are not duplicated after new tables registered. Returns paths of files not used by other WARC files"""
+    old_paths = {}
+    for table in list_tables:
+        row = con.execute("select path from tables where warcfile = ? and type = ?", [table['warcfile'], table['type']]).fetchone()
+        if row is None or row[0] == table['path'] or not table_exists(row[0]):
+            continue
+        old_paths.setdefault((row[0], table['type']), []).append(table['warcfile'])
+    released = []
+    for (path, table_type), warcfiles in old_paths.items():
+        others = [x[0] for x in con.execute("select warcfile from tables where path = ? and type = ?", [path, table_type]).fetchall() if x[0] not in warcfiles]
+        if len(others) > 0:
+            exclude_sources(con, path, warcfiles)
+        else:
+            released.append(path)
+    return released
+
+
+def table_paths(con, table_type:str='records', warcfiles:list=None, silent:bool=True):
+    """Returns paths of parquet files of selected type for all or selected WARC files with one catalog query.
+    Missing files skipped"""
+    from rich import print
+    glob_tables = [x[0] for x in con.sql('show tables').fetchall()]
+    if 'tables' not in glob_tables:
+        return []
+    catalog = dict(con.execute("select warcfile, path from tables where type = ?", [table_type]).fetchall())
+    if warcfiles is None:
+        warcfiles = [x[0] for x in con.sql('select filename from files;').fetchall()]
+    paths = []
+    seen = set()
+    for filename in warcfiles:
+        if filename in catalog.keys() and catalog[filename] in seen:
+            # compacted file shared by several WARC files
+            continue
+        if filename not in catalog.keys():
+            if not silent:
+                print(f'{table_type.capitalize()} table for {filename} not found. Please reindex')
+            continue
+        path = catalog[filename]
+        if not table_exists(path):
+            if not silent:
+                print(f'{table_type.capitalize()} table file {path} for {filename} not found. Please reindex or ignore')
+            continue
+        paths.append(path)
+        seen.add(path)
+    return paths
+
+
+def records_scan(con, warcfiles:list=None, silent:bool=True):
+    """Returns scan over records tables of all or selected WARC files or None if no records tables found"""
+    paths = table_paths(con, 'records', warcfiles, silent=silent)
+    if len(paths) == 0:
+        return None
+    return parquet_scan(paths)
+
+
+LOOKUP_COLUMNS = ['offset', 'filename', 'url', 'length', 'content_type', 'ext', 'status_code', 'warc_id', 'source']
+
+
+def ensure_lookup(con):
+    """Creates lookup table with ART indexes on warc_id and url if not exists. Records of WARC files already in catalog
+    added once when table created. Returns True if table created"""
+    glob_tables = [x[0] for x in con.sql('show tables').fetchall()]
+    if 'lookup' in glob_tables:
+        return False
+    con.sql('CREATE TABLE lookup ("offset" BIGINT, filename VARCHAR, url VARCHAR, length BIGINT, content_type VARCHAR, ext VARCHAR, status_code BIGINT, warc_id VARCHAR, source VARCHAR);')
+    if 'tables' in glob_tables:
+        rows = con.sql("SELECT warcfile, path, type FROM tables WHERE type = 'records'").fetchall()
+        insert_lookup(con, [{'warcfile' : warcfile, 'path' : path, 'type' : table_type} for warcfile, path, table_type in rows])
+    # indexes built after initial load, it's faster than updating them on insert
+    con.sql('CREATE INDEX lookup_warc_id_idx ON lookup (warc_id);')
+    con.sql('CREATE INDEX lookup_url_idx ON lookup (url);')
+    return True
+
+
+def insert_lookup(con, list_tables:list):
+    """Inserts records of WARC files into lookup table, shared records file read once"""
+    sources = {}
+    for table in list_tables:
+        if table['type'] == 'records' and table_exists(table['path']):
+            sources.setdefault(table['path'], []).append(table['warcfile'])
+    prep_columns = ','.join(['"' + sub + '"' for sub in LOOKUP_COLUMNS])
+    for path, path_warcfiles in sources.items():
+        prep_sources = ','.join(["'" + source.replace("'", "''") + "'" for source in path_warcfiles])
+        con.sql(f"INSERT INTO lookup SELECT {prep_columns} FROM {parquet_scan([path])} WHERE source IN ({prep_sources})")
+
+
+def update_lookup(con, list_tables:list):
+    """Replaces records of indexed WARC files in lookup table, so single record found by index scan instead of
+    reading all records tables. Previous records of all files removed with one query"""
+    if ensure_lookup(con):
+        # just created from catalog with indexed files
+        return
+    warcfiles = [table['warcfile'] for table in list_tables if table['type'] == 'records']
+    if len(warcfiles) == 0:
+        return
+    prep_sources = ','.join(["'" + source.replace("'", "''") + "'" for source in warcfiles])
+    con.sql(f"DELETE FROM lookup WHERE source IN ({prep_sources})")
+    insert_lookup(con, list_tables)
+
+
+def find_record(con, fileid:str):
+    """Finds record by warc_id or url in lookup table. Returns row with lookup columns or None if not found"""
+    prep_columns = ','.join(['"' + sub + '"' for sub in LOOKUP_COLUMNS])
+    # separate queries since index used only for single column equality
+    for column in ['warc_id', 'url']:
+        row = con.execute(f"select {prep_columns} from lookup where {column} = ? limit 1", [fileid]).fetchone()
+        if row is not None:
+            return row
+    return None
+
+
+# Expressions of records table columns used as keys of partial aggregates
+STATS_DIMENSIONS = {
+    'mimes' : 'c_type',
+    'exts' : 'ext',
+    'statuses' : 'status_code::VARCHAR',
+    'hosts' : "lower(regexp_extract(url, '^[^:/?#]+://(?:[^/?#@]*@)?([^/?#:]*)', 1))",
+    'dates' : "strftime(timezone('UTC', rec_date), '%Y-%m-%d')",
+}
+
+
+def ensure_stats(con):
+    """Creates stats table with partial aggregates of records of each WARC file if not exists"""
+    glob_tables = [x[0] for x in con.sql('show tables').fetchall()]
+    if 'stats' not in glob_tables:
+        con.sql("CREATE TABLE stats (warcfile VARCHAR, dimension VARCHAR, key VARCHAR, size BIGINT, count BIGINT);")
+
+
+def update_stats(con, list_tables:list):
+    """Replaces partial aggregates of records of indexed WARC files by mime, extension, status code, host and date,
+    so stats merged from small table instead of reading all records tables. Shared records file read once for all it's WARC files"""
+    ensure_stats(con)
+    sources = {}
+    for table in list_tables:
+        if table['type'] == 'records':
+            con.execute('DELETE FROM stats WHERE warcfile = ?', [table['warcfile']])
+            if table_exists(table['path']):
+                sources.setdefault(table['path'], []).append(table['warcfile'])
+    for path, warcfiles in sources.items():
+        prep_sources = ','.join(["'" + source.replace("'", "''") + "'" for source in warcfiles])
+        keys = ', '.join([f'{expr} AS {dimension}' for dimension, expr in STATS_DIMENSIONS.items()])
+        groups = ' UNION ALL '.join([f"SELECT source, '{dimension}', {dimension}, SUM(content_length), COUNT(*) FROM r GROUP BY source, {dimension}" for dimension in STATS_DIMENSIONS.keys()])
+        con.sql(f"""INSERT INTO stats WITH r AS MATERIALIZED (SELECT source, content_length, {keys} FROM {parquet_scan([path])} WHERE source IN ({prep_sources}))
+                    {groups}""")
+
+
+def refresh_stats(con):
+    """Adds partial aggregates of WARC files indexed before stats table created and removes ones of WARC files without records"""
+    ensure_stats(con)
+    glob_tables = [x[0] for x in con.sql('show tables').fetchall()]
+    if 'tables' not in glob_tables:
+        return
+    con.sql("DELETE FROM stats WHERE warcfile NOT IN (SELECT warcfile FROM tables WHERE type = 'records')")
+    rows = con.sql("SELECT warcfile, path, type FROM tables WHERE type = 'records' AND warcfile NOT IN (SELECT DISTINCT warcfile FROM stats)").fetchall()
+    update_stats(con, [{'warcfile' : warcfile, 'path' : path, 'type' : table_type} for warcfile, path, table_type in rows])
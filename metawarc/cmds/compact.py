@@ -0,0 +1,128 @@
+import os
+import glob
+import logging
+from datetime import datetime
+
+import duckdb
+import pyarrow as pa
+
+from .catalog import ensure_catalog, parquet_scan
+from .dataset import table_exists, remove_table, DEFAULT_OUTPUT_ROOT
+from .writer import TableWriter, TableLayout, RECORDS_SCHEMA, HEADERS_SCHEMA, LINKS_SCHEMA, DEFAULT_BATCH_SIZE
+
+
+DEFAULT_TARGET_SIZE = 512 * 1024 * 1024
+DEFAULT_COMPACT_TABLES = ['records', 'headers']
+DEFAULT_COMPACT_SORT = ['source', 'offset']
+COMPACTED_DIR = 'compacted'
+
+TABLE_SCHEMAS = {'records' : RECORDS_SCHEMA, 'headers' : HEADERS_SCHEMA, 'links' : LINKS_SCHEMA}
+
+
+def table_size(path:str):
+    """Returns size of table file or total size of files matching glob pattern"""
+    if glob.has_magic(path):
+        return sum([os.path.getsize(name) for name in glob.glob(path, recursive=True)])
+    return os.path.getsize(path)
+
+
+def plan_groups(units:list, target_size:int):
+    """Splits list of table files into groups with total size up to target size"""
+    groups = []
+    current = []
+    current_size = 0
+    for unit in units:
+        if len(current) > 0 and current_size + unit['size'] > target_size:
+            groups.append(current)
+            current = []
+            current_size = 0
+        current.append(unit)
+        current_size += unit['size']
+    if len(current) > 0:
+        groups.append(current)
+    return groups
+
+
+class Compactor:
+    """Merges small parquet files of WARC files into larger sorted files and updates tables catalog"""
+
+    def __init__(self, root:str=DEFAULT_OUTPUT_ROOT):
+        self.root = root
+        self.compacted_dir = os.path.join(root, COMPACTED_DIR)
+
+    def is_compacted(self, path:str):
+        return os.path.abspath(path).startswith(os.path.abspath(self.compacted_dir) + os.sep)
+
+    def candidates(self, con, table_type:str, target_size:int, full:bool=False):
+        """Returns table files to compact with WARC files they belong to. Without full option only files not compacted yet
+        and compacted files smaller than half of target size selected"""
+        units = {}
+        rows = con.execute("select warcfile, path, num_items from tables where type = ? order by warcfile", [table_type]).fetchall()
+        for warcfile, path, num_items in rows:
+            if path not in units.keys():
+                if not table_exists(path):
+                    continue
+                size = table_size(path)
+                if not full and self.is_compacted(path) and size >= target_size // 2:
+                    continue
+                units[path] = {'path' : path, 'size' : size, 'entries' : []}
+            units[path]['entries'].append({'warcfile' : warcfile, 'num_items' : num_items})
+        return list(units.values())
+
+    def compact_group(self, con, table_type:str, group:list, filename:str, layout:TableLayout, batch_size:int=DEFAULT_BATCH_SIZE):
+        """Writes rows of group files into single file. Returns number of rows"""
+        paths = [unit['path'] for unit in group]
+        reader = con.sql(f"SELECT * FROM {parquet_scan(paths)}").to_arrow_reader(batch_size)
+        schema = TABLE_SCHEMAS.get(table_type, reader.schema)
+        group_layout = TableLayout(sort_by=[name for name in layout.sort_by if name in schema.names], row_group_size=layout.row_group_size,
+                                   compression_level=layout.compression_level, bloom_filters=layout.bloom_filters, encodings=layout.encodings)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with TableWriter(filename, schema, batch_size=batch_size, layout=group_layout) as writer:
+            for batch in reader:
+                for casted in pa.Table.from_batches([batch]).cast(schema).to_batches():
+                    writer.write_batch(casted)
+        return writer.num_rows
+
+    def compact(self, dbfile:str='warcindex.db', table_types:list=DEFAULT_COMPACT_TABLES, target_size:int=DEFAULT_TARGET_SIZE, layout:TableLayout=None, full:bool=False, batch_size:int=DEFAULT_BATCH_SIZE, silent:bool=False):
+        """Compacts parquet files of selected table types"""
+        from rich import print
+        if layout is None:
+            layout = TableLayout(sort_by=DEFAULT_COMPACT_SORT)
+        con = duckdb.connect(dbfile)
+        ensure_catalog(con)
+        stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        for table_type in table_types:
+            units = self.candidates(con, table_type, target_size, full=full)
+            groups = [group for group in plan_groups(units, target_size) if len(group) > 1 or not self.is_compacted(group[0]['path'])]
+            if len(groups) == 0:
+                if not silent:
+                    print(f'No {table_type} files to compact')
+                continue
+            for num, group in enumerate(groups):
+                filename = os.path.join(self.compacted_dir, table_type, '%s-%05d.parquet' % (stamp, num))
+                expected = sum([entry['num_items'] for unit in group for entry in unit['entries']])
+                try:
+                    num_rows = self.compact_group(con, table_type, group, filename, layout, batch_size=batch_size)
+                except (duckdb.Error, pa.ArrowException) as err:
+                    logging.info('Unable to compact %s files: %s' % (table_type, str(err)))
+                    if not silent:
+                        print(f'Unable to compact {len(group)} {table_type} files: {str(err)}')
+                    continue
+                if num_rows != expected:
+                    # catalog not matches files, nothing changed
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                    if not silent:
+                        print(f'Number of {table_type} rows {num_rows} not equal to catalog {expected}. Skipping')
+                    continue
+                # all WARC files of group switched to new file at once
+                con.begin()
+                for unit in group:
+                    for entry in unit['entries']:
+                        con.execute("UPDATE tables SET path = ? WHERE warcfile = ? AND type = ?", [filename, entry['warcfile'], table_type])
+                con.commit()
+                for unit in group:
+                    remove_table(unit['path'])
+                if not silent:
+                    print(f'- compacted {len(group)} {table_type} files with {num_rows} rows into {filename}')
+        con.close()
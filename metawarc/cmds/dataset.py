@@ -0,0 +1,175 @@
+import os
+import glob
+import hashlib
+import logging
+
+import pyarrow as pa
+
+from ..constants import MIMES_EXT_TYPE_BY_GROUP
+from .writer import TableWriter, TableLayout, DEFAULT_BATCH_SIZE
+
+
+DEFAULT_OUTPUT_ROOT = 'data'
+
+OTHER_GROUP = 'other'
+MIME_GROUPS = {mime : group for group, value in MIMES_EXT_TYPE_BY_GROUP.items() for mime in value['mimes']}
+
+# Tables split by content type group in partitioned mode
+GROUPED_TABLES = ['records']
+
+
+def warc_basename(filename:str):
+    """Returns lowercased WARC file name without .warc or .warc.gz extension"""
+    file_basename = os.path.basename(filename).lower()
+    if file_basename[-5:] == '.warc':
+        file_basename = file_basename[0:-5]
+    elif file_basename[-8:] == '.warc.gz':
+        file_basename = file_basename[0:-8]
+    return file_basename
+
+
+def crawl_basename(filename:str):
+    """Returns lowercased name of directory of WARC file used as crawl name"""
+    return os.path.basename(os.path.dirname(os.path.abspath(filename))).lower()
+
+
+def mime_group(c_type:str):
+    """Returns content type group like pdfs or images for mime type"""
+    return MIME_GROUPS.get(c_type, OTHER_GROUP)
+
+
+def table_exists(path:str):
+    """Checks that table file exists or glob pattern of partitioned table matches at least one file"""
+    if glob.has_magic(path):
+        return len(glob.glob(path, recursive=True)) > 0
+    return os.path.exists(path)
+
+
+def remove_table(path:str):
+    """Removes table file or all files matching glob pattern"""
+    names = glob.glob(path, recursive=True) if glob.has_magic(path) else [path]
+    for name in names:
+        os.remove(name)
+
+
+def is_partitioned(path:str):
+    """Checks that table path is part of hive partitioned dataset"""
+    return path.find(os.sep + 'type=') > -1 or path.startswith('type=')
+
+
+class PartitionedWriter:
+    """Writes rows of WARC file table to hive partitioned directory shared by WARC files of the crawl,
+    one file named after WARC file per content type group. Group files left from previous indexing removed on close"""
+
+    def __init__(self, directory:str, name:str, schema:pa.Schema, batch_size:int=DEFAULT_BATCH_SIZE, layout:TableLayout=None):
+        self.directory = directory
+        self.name = name
+        self.schema = schema
+        self.batch_size = batch_size
+        self.layout = layout
+        self.writers = {}
+        self.num_rows = 0
+
+    def path(self, group:str):
+        return os.path.join(self.directory, f'c_type_group={group}', self.name + '.parquet')
+
+    def _writer(self, group:str):
+        if group not in self.writers.keys():
+            os.makedirs(os.path.dirname(self.path(group)), exist_ok=True)
+            self.writers[group] = TableWriter(self.path(group), self.schema, batch_size=self.batch_size, layout=self.layout)
+        return self.writers[group]
+
+    def write(self, row:dict):
+        self._writer(mime_group(row.get('c_type'))).write(row)
+
+    def write_many(self, rows:list):
+        for row in rows:
+            self.write(row)
+
+    def write_batch(self, batch:pa.RecordBatch):
+        """Splits record batch by content type group"""
+        groups = [mime_group(c_type) for c_type in batch.column('c_type').to_pylist()]
+        for group in set(groups):
+            mask = pa.array([value == group for value in groups])
+            self._writer(group).write_batch(batch.filter(mask))
+
+    def close(self):
+        """Closes group files and removes stale ones. Returns number of rows written"""
+        self.num_rows = 0
+        for writer in self.writers.values():
+            self.num_rows += writer.close()
+        for path in glob.glob(os.path.join(glob.escape(self.directory), 'c_type_group=*', glob.escape(self.name) + '.parquet')):
+            if path not in [self.path(group) for group in self.writers.keys()]:
+                os.remove(path)
+                logging.debug('Removed stale partition file %s' % path)
+        return self.num_rows
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class Dataset:
+    """Places parquet tables of WARC files under output root. Tables written as flat files named after WARC file
+    like root/<name>_records.parquet or as hive partitioned dataset like root/type=records/crawl=<crawl>/c_type_group=pdfs/<name>.parquet.
+    WARC files of one crawl share partition directories, crawl name set explicitly or taken from WARC file directory"""
+
+    def __init__(self, root:str=DEFAULT_OUTPUT_ROOT, partitioned:bool=False, crawl:str=None):
+        self.root = root
+        self.partitioned = partitioned
+        self.crawl = crawl
+
+    def crawl_name(self, warcfile:str):
+        return self.crawl if self.crawl else crawl_basename(warcfile)
+
+    def table_dir(self, warcfile:str, table_type:str):
+        return os.path.join(self.root, f'type={table_type}', f'crawl={self.crawl_name(warcfile)}')
+
+    def table_path(self, warcfile:str, table_type:str):
+        """Returns path of table file or glob pattern of group files registered in catalog"""
+        if not self.partitioned:
+            return os.path.join(self.root, warc_basename(warcfile) + f'_{table_type}.parquet')
+        if table_type in GROUPED_TABLES:
+            return os.path.join(glob.escape(self.table_dir(warcfile, table_type)), 'c_type_group=*', glob.escape(warc_basename(warcfile)) + '.parquet')
+        return os.path.join(self.table_dir(warcfile, table_type), warc_basename(warcfile) + '.parquet')
+
+    def work_name(self, warcfile:str):
+        """Returns name of temporary files of WARC file, unique for WARC files with the same name in different directories"""
+        digest = hashlib.sha1(os.path.abspath(warcfile).encode('utf8')).hexdigest()
+        return warc_basename(warcfile) + '-' + digest[:12]
+
+    def part_path(self, warcfile:str, table_type:str, part:int):
+        """Returns path of temporary file with part of table, merged after all parts written"""
+        return os.path.join(self.root, self.work_name(warcfile) + '_%s.part-%05d.parquet' % (table_type, part))
+
+    def checkpoint_path(self, warcfile:str):
+        """Returns path of file with state of interrupted indexing of WARC file"""
+        return os.path.join(self.root, self.work_name(warcfile) + '.checkpoint.json')
+
+    def exists(self, warcfile:str, table_type:str):
+        return table_exists(self.table_path(warcfile, table_type))
+
+    def prepare(self, warcfile:str, table_type:str):
+        """Creates directories for table and returns it's path"""
+        path = self.table_path(warcfile, table_type)
+        if self.partitioned and table_type in GROUPED_TABLES:
+            os.makedirs(self.table_dir(warcfile, table_type), exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        return path
+
+    def open_writer(self, warcfile:str, table_type:str, schema:pa.Schema, batch_size:int=DEFAULT_BATCH_SIZE, layout:TableLayout=None):
+        """Returns writer of table of WARC file"""
+        path = self.prepare(warcfile, table_type)
+        if self.partitioned and table_type in GROUPED_TABLES:
+            return PartitionedWriter(self.table_dir(warcfile, table_type), warc_basename(warcfile), schema, batch_size=batch_size, layout=layout)
+        return TableWriter(path, schema, batch_size=batch_size, layout=layout)
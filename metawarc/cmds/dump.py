@@ -4,12 +4,25 @@ from datetime import datetime
 import logging
 import json
 import io
-from warcio import ArchiveIterator
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import tqdm
 from warcio.utils import BUFF_SIZE
 from ..constants import MIME_EXT_MAP
+from .reader import WarcRecordReader, read_record
+from .catalog import table_paths, parquet_scan, find_record, ensure_lookup
+from .dataset import is_partitioned, mime_group, warc_basename
+from .shards import ShardSet, copy_stream, SHARD_COLUMNS, DEFAULT_SHARD_SIZE
+from .payload import RangeReader, payload_range, payload_stream, copy_range
+from .cache import ContentCache, DEFAULT_CACHE_SIZE
 
 READ_SIZE = BUFF_SIZE * 4
 
+# Max number of records of one WARC file extracted by one task
+DUMP_CHUNK_SIZE = 100
+DEFAULT_DUMP_WORKERS = 4
+
 import duckdb
 
 
@@ -22,12 +35,164 @@ def get_ext_from_content_type(content_type):
             return MIME_EXT_MAP[content_type]
     return 'unknown'
 
+
+def record_filename(record, raw:bool=False):
+    """Returns name of dumped file from record id or WARC file name and offset if record id is unknown.
+    Raw records named with extension of source WARC file"""
+    name = record[7] if record[7] else '%s-%d' % (warc_basename(record[8]), record[0])
+    if raw:
+        return name + ('.warc.gz' if record[8].lower().endswith('.gz') else '.warc')
+    return name + '.' + get_ext_from_content_type(record[4])
+
+
+def record_range(fileobj, record, raw:bool=False):
+    """Returns byte range of record in WARC file copied without decoding: whole record in raw mode or payload of uncompressed record
+    stored as is. None if payload should be decoded"""
+    if raw:
+        return record[0], record[3]
+    return payload_range(fileobj, record[0])
+
+
+# Record length of uncompressed WARC file not includes records separator, it's added to raw records
+RECORD_SEPARATOR = b'\r\n\r\n'
+
+
+def record_suffix(record, raw:bool=False):
+    """Returns bytes written after raw record copied from uncompressed WARC file to make it valid WARC record"""
+    if raw and not record[8].lower().endswith('.gz'):
+        return RECORD_SEPARATOR
+    return b''
+
+
+class SuffixReader:
+    """Reads stream followed by suffix bytes"""
+
+    def __init__(self, stream, suffix:bytes):
+        self.stream = stream
+        self.suffix = suffix
+
+    def read(self, size:int=-1):
+        buf = self.stream.read(size)
+        if buf or not self.suffix:
+            return buf
+        if size is None or size < 0:
+            size = len(self.suffix)
+        buf, self.suffix = self.suffix[:size], self.suffix[size:]
+        return buf
+
+
+def cached_payload(cache:ContentCache, fileobj, record, raw:bool=False):
+    """Returns opened cached payload of record, on miss payload extracted to cache. None if cache not used or record has no id"""
+    if cache is None or raw or not record[7]:
+        return None
+    return cache.fetch(record[7], lambda: payload_stream(fileobj, record[0]))
+
+
+def dump_chunk(reader:WarcRecordReader, records:list, output:str, shards:ShardSet=None, raw:bool=False, cache:ContentCache=None):
+    """Writes payloads or raw records of single WARC file sorted by offset as files or into shards.
+    Byte ranges not needing decoding and cached payloads written to files with sendfile. Returns number of bytes written, read statistics and locations of records in shards"""
+    written = 0
+    locations = []
+    with reader.open(records[0][8]) as fileobj:
+        for record in records:
+            filename = record_filename(record, raw=raw)
+            if shards is not None and shards.shard_format == 'warc':
+                # original record copied without parsing
+                shard = shards.current()
+                shard_offset, shard_length = shard.add_record(fileobj, record[0], record[3])
+                locations.append([os.path.basename(shard.filename), shard_offset, shard_length])
+                written += shard_length
+                continue
+            cached = cached_payload(cache, fileobj, record, raw=raw)
+            byte_range = (0, os.fstat(cached.fileno()).st_size) if cached is not None else record_range(fileobj, record, raw=raw)
+            source = cached if cached is not None else fileobj
+            try:
+                if shards is not None:
+                    if byte_range is not None:
+                        stream = RangeReader(source, byte_range[0], byte_range[1])
+                    else:
+                        stream = read_record(fileobj, record[0]).content_stream()
+                    suffix = record_suffix(record, raw=raw)
+                    shard = shards.current()
+                    shard_offset, shard_length = shard.add_payload(filename, SuffixReader(stream, suffix) if suffix else stream)
+                    locations.append([os.path.basename(shard.filename), shard_offset, shard_length])
+                    written += shard_length
+                else:
+                    with open(os.path.join(output, filename), 'wb') as out_raw:
+                        if byte_range is not None:
+                            written += copy_range(source, out_raw, byte_range[0], byte_range[1])
+                            if source is fileobj:
+                                # range copied with sendfile bypasses mapping
+                                fileobj.touch(byte_range[0], byte_range[1])
+                        else:
+                            written += copy_stream(read_record(fileobj, record[0]).content_stream(), out_raw)
+                        suffix = record_suffix(record, raw=raw)
+                        out_raw.write(suffix)
+                        written += len(suffix)
+            finally:
+                if cached is not None:
+                    cached.close()
+            logging.debug('Wrote %s, url %s' % (filename, record[2]))
+    return written, fileobj.bytes_read, fileobj.reads, fileobj.bytes_skipped, locations
+
+
 class Dumper:
     """Dumps data files from WARC file"""
 
     def __init__(self):
         pass
 
+    def select_records(self, con, warcfiles:list, headers:list, mimes:str=None, exts:str=None, query:str=None, start:int=0, limit:int=1000, silent:bool=False, ordered:bool=False, fetch:bool=True):
+        """Selects records of all WARC files with single query over their records tables. Returns list of rows or None.
+        Records ordered by source and offset if ordered set, without fetch option query result returned to read rows in batches"""
+        from rich import print
+        paths = table_paths(con, 'records', warcfiles, silent=silent)
+        if len(paths) == 0:
+            if not silent:
+                print('No records tables found. Please reindex')
+            return None
+        # partition columns used to skip files of other content type groups
+        partitioned = all([is_partitioned(path) for path in paths])
+        scan = parquet_scan(paths, hive_partitioning=partitioned)
+        if warcfiles is not None:
+            # compacted files could have records of other WARC files
+            prep_sources = ','.join(["'" + sub.replace("'", "''") + "'" for sub in warcfiles])
+            scan = f"(select * from {scan} where source in ({prep_sources}))"
+        prep_headers = ','.join(['"' + sub + '"' for sub in headers])
+        if mimes is not None:
+            prep_mimes = ','.join(["'" + sub + "'" for sub in mimes.split(',')])
+            s = f"select {prep_headers} from {scan} where c_type in ({prep_mimes})"
+            if partitioned:
+                prep_groups = ','.join(["'" + sub + "'" for sub in set([mime_group(mime) for mime in mimes.split(',')])])
+                s = f"select {prep_headers} from {scan} where c_type_group in ({prep_groups}) and c_type in ({prep_mimes})"
+        elif exts is not None:
+            prep_exts = ','.join(["'" + sub + "'" for sub in exts.split(',')])
+            s = f"select {prep_headers} from {scan} where ext in ({prep_exts})"
+        elif query is not None:
+            s = f"select {prep_headers} from {scan} where {query}"
+        else:
+            s = f"select {prep_headers} from {scan} order by source, \"offset\" offset {start} limit {limit}"
+        if ordered and (mimes is not None or exts is not None or query is not None):
+            s += ' order by source, "offset"'
+        if not fetch:
+            return con.execute(s)
+        return con.sql(s).fetchall()
+
+    def source_chunks(self, result, source_index:int, chunk_size:int=DUMP_CHUNK_SIZE):
+        """Reads rows ordered by source from query result in batches and yields chunks of rows of one WARC file"""
+        chunk = []
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                if len(chunk) > 0 and (row[source_index] != chunk[0][source_index] or len(chunk) >= chunk_size):
+                    yield chunk
+                    chunk = []
+                chunk.append(row)
+        if len(chunk) > 0:
+            yield chunk
+
     def listfiles(self, warcfiles:str=None, dbfile:str='warcindex.db', mimes:list=None, exts:list=None, query:str=None, start:int=0, limit:int=1000, output:str=None, silent:bool=False):
         """Lists files in WARC file"""
         from rich.table import Table
@@ -39,55 +204,11 @@ class Dumper:
             print('Plese generate %s database with "metawarc index <filename.warc> command"' % dbfile)
             return
 
-        if warcfiles  is None:
-            files = [item['filename'] for item in con.sql('select filename from files;').df().to_dict('records')]
-        else:
-            files = warcfiles            
-
         headers = ['offset', 'url', 'length', 'content_type', 'ext', 'warc_id']
-        prep_headers = ','.join(['"' + sub + '"' for sub in headers]) 
-        results = None
-        outdata = []
-
-        for filename in files:
-            rectables = con.sql(f"select * from tables where type = 'records' and warcfile = \'{filename}\';").df().to_dict('records')
-            if len(rectables) == 0:
-                if not silent:
-                    print(f'Records table for {filename} not found. Please reindex')
-                continue
-            else:
-                recfilepath = rectables[0]['path']
-
-            if not os.path.exists(recfilepath):
-                if not silent:
-                    print(f'Records table file {recfilepath} for {filename} not found. Please reindex or ignore')
-                continue
-
+        outdata = self.select_records(con, warcfiles, headers, mimes=mimes, exts=exts, query=query, start=start, limit=limit, silent=silent)
+        if outdata is None:
+            return
 
-            if mimes is not None:
-                prep_mimes = ','.join(["'" + sub + "'" for sub in mimes.split(',')])
-                s = f"select {prep_headers} from '{recfilepath}' where c_type in ({prep_mimes})"
-    #            print('Query', s)
-                results = con.sql(s).fetchall()
-            elif exts is not None:
-                prep_exts = ','.join(["'" + sub + "'" for sub in exts.split(',')])
-                s = f"select {prep_headers} from '{recfilepath}' where ext in ({prep_exts})"
-                #print('Query', s)
-                results = con.sql(s).fetchall()
-            elif query is not None:
-                s = f"select {prep_headers} from '{recfilepath}' where {query}"            
-                results = con.sql(s).fetchall()
-            else:
-                s = f"select {prep_headers} from '{recfilepath}' offset {start} limit {limit}"            
-                results = con.sql(s).fetchall()
-            if results is None:
-                if not silent:
-                    print('At least one parameter: query, exts or mimes should be provided')
-                return 
-            else:
-                for record in results:
-                    outdata.append(record)
-        
         if output is None:
             title = 'URL/file list'
             reptable = Table(title=title)
@@ -103,9 +224,12 @@ class Dumper:
             writer.writerow(headers)
             writer.writerows(outdata)
 
-    def dump(self, warcfiles:str=None, dbfile='warcindex.db', mimes:str=None, exts:str=None, query:str=None, start:int=0, limit:int=1000, output:str=None, silent:bool=False):
-        """Dump WARC file contents"""
-        from rich.table import Table
+    def dump(self, warcfiles:str=None, dbfile='warcindex.db', mimes:str=None, exts:str=None, query:str=None, start:int=0, limit:int=1000, output:str=None, silent:bool=False, workers:int=DEFAULT_DUMP_WORKERS,
+             shard_format:str=None, shard_size:int=DEFAULT_SHARD_SIZE, raw:bool=False, cache_dir:str=None, cache_size:int=DEFAULT_CACHE_SIZE):
+        """Dump WARC file contents. Selected records streamed from query result, records of each WARC file extracted
+        by chunks in thread pool, number of chunks in progress limited. With shard format payloads written into tar or zip shards
+        or original records into WARC shards, shard name and offset of each record added to records.csv. In raw mode records written as stored in WARC file.
+        With cache directory payloads read from cache of previous runs and extracted payloads cached"""
         from rich import print
         if not os.path.exists(dbfile):
             print('Plese generate %s database with "metawarc index <filename.warc> command"' % dbfile)
@@ -114,83 +238,67 @@ class Dumper:
 
         con = duckdb.connect(dbfile)
 
-        if warcfiles  is None:
-            files = [item['filename'] for item in con.sql('select filename from files;').df().to_dict('records')]
-        else:
-            files = warcfiles            
-
         headers = ['offset', 'filename', 'url', 'length', 'content_type', 'ext', 'status_code', 'warc_id', 'source']
-        prep_headers = ','.join(['"' + sub + '"' for sub in headers]) 
-        results = None
-        outdata = []
-
-        for filename in files:
-            rectables = con.sql(f"select * from tables where type = 'records' and warcfile = \'{filename}\';").df().to_dict('records')
-            if len(rectables) == 0:
-                if not silent:
-                    print(f'Records table for {filename} not found. Please reindex')
-                continue
-            else:
-                recfilepath = rectables[0]['path']
+        # Records read in order of source file and offset, nearby records read together by read ahead buffer
+        result = self.select_records(con, warcfiles, headers, mimes=mimes, exts=exts, query=query, start=start, limit=limit, silent=silent, ordered=True, fetch=False)
+        if result is None:
+            return
+        os.makedirs(output, exist_ok=True)
+        shards = ShardSet(output, shard_format, shard_size) if shard_format is not None else None
+        output_file = open(os.path.join(output, 'records.csv'), 'w', encoding='utf8')
+        writer = csv.writer(output_file)
+        writer.writerow(headers if shards is None else headers + SHARD_COLUMNS)
 
-            if not os.path.exists(recfilepath):
-                if not silent:
-                    print(f'Records table file {recfilepath} for {filename} not found. Please reindex or ignore')
-                continue
+        totals = {'files' : 0, 'written' : 0, 'read' : 0, 'reads' : 0, 'skipped' : 0}
+        reader = WarcRecordReader()
+        cache = ContentCache(cache_dir, cache_size) if cache_dir is not None else None
+        progress = None if silent else tqdm.tqdm(desc='Dump files', unit='B', unit_scale=True)
+        started = time.perf_counter()
+        pending = deque()
 
-            if mimes is not None:
-                prep_mimes = ','.join(["'" + sub + "'" for sub in mimes.split(',')])
-                s = f"select {prep_headers} from '{recfilepath}' where c_type in ({prep_mimes})"
-    #            print('Query', s)
-                results = con.sql(s).fetchall()
-            elif exts is not None:
-                prep_exts = ','.join(["'" + sub + "'" for sub in exts.split(',')])
-                s = f"select {prep_headers} from '{recfilepath}' where ext in ({prep_exts})"
-                #print('Query', s)
-                results = con.sql(s).fetchall()
-            elif query is not None:
-                s = f"select {prep_headers} from '{recfilepath}' where {query}"            
-                results = con.sql(s).fetchall()
+        def collect():
+            """Waits for oldest chunk, so records.csv written in order of records"""
+            chunk, future = pending.popleft()
+            written, read, reads, skipped, locations = future.result()
+            if shards is None:
+                writer.writerows(chunk)
             else:
-                s = f"select {prep_headers} from '{recfilepath}' offset {start} limit {limit}"            
-                results = con.sql(s).fetchall()
-            if results is None:
-                if not silent:
-                    print('At least one parameter: query, exts or mimes should be provided')
-                return                 
-            else:
-                for record in results:
-                    outdata.append(record)
-        os.makedirs(output, exist_ok=True)
-        opened_files = {}
-        final_data = []
-        for record in outdata:            
-            if record[8] in opened_files.keys():
-                fileobj = opened_files[record[8]]
-            else:
-                fileobj = open(record[8], "rb")
-                opened_files[record[8]] = fileobj
-            fileobj.seek(record[0])
-            it = iter(ArchiveIterator(fileobj))
-            warcrec = next(it)
-            filename = record[7] + '.' + get_ext_from_content_type(record[4])
-            final_data.append(record)            
-            out_raw = open(os.path.join(output, filename), 'wb')
-            stream = warcrec.content_stream()
-            buf = stream.read(READ_SIZE)
-            while buf:
-                out_raw.write(buf)
-                buf = stream.read(READ_SIZE)
-            out_raw.close()
-            print('Wrote %s, url %s' % (filename, record[2]))
-        output_file = os.path.join(output, 'records.csv')
-        writer = csv.writer(open(output_file, 'w', encoding='utf8'))
-        writer.writerow(headers)
-        writer.writerows(final_data)
-
-
-    def get_file(self, fileid:str=None, dbfile='warcindex.db', output:str=None, silent:bool=False):
-        """Dump WARC file contents"""
+                writer.writerows([list(row) + location for row, location in zip(chunk, locations)])
+            totals['files'] += len(chunk)
+            totals['written'] += written
+            totals['read'] += read
+            totals['reads'] += reads
+            totals['skipped'] += skipped
+            if progress is not None:
+                progress.update(written)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for chunk in self.source_chunks(result, headers.index('source')):
+                    pending.append((chunk, executor.submit(dump_chunk, reader, chunk, output, shards, raw, cache)))
+                    if len(pending) >= workers * 2:
+                        collect()
+                while len(pending) > 0:
+                    collect()
+        finally:
+            reader.close()
+            if shards is not None:
+                shards.close()
+            output_file.close()
+            if progress is not None:
+                progress.close()
+        elapsed = time.perf_counter() - started
+        if not silent:
+            print('Wrote %d files, %0.2f MB in %0.2f sec, %0.2f MB/s' % (totals['files'], totals['written'] / 1048576.0, elapsed, totals['written'] / 1048576.0 / elapsed if elapsed > 0 else 0))
+            print('Read %0.2f MB in %d ranges, skipped %0.2f MB' % (totals['read'] / 1048576.0, totals['reads'], totals['skipped'] / 1048576.0))
+            if cache is not None:
+                print(cache.stats().capitalize())
+            if shards is not None:
+                print('Records written into %d %s shards' % (len(shards.filenames), shard_format))
+
+
+    def get_file(self, fileid:str=None, dbfile='warcindex.db', output:str=None, silent:bool=False, raw:bool=False, cache_dir:str=None, cache_size:int=DEFAULT_CACHE_SIZE):
+        """Dump WARC file contents. Payloads of uncompressed records stored as is, cached payloads and raw records copied with sendfile"""
         from rich.table import Table
         from rich import print
         if not os.path.exists(dbfile):
@@ -200,49 +308,28 @@ class Dumper:
         con = duckdb.connect(dbfile)
 
 
-        files = [item['filename'] for item in con.sql('select filename from files;').df().to_dict('records')]
-
-        headers = ['offset', 'filename', 'url', 'length', 'content_type', 'ext', 'status_code', 'warc_id', 'source']
-        prep_headers = ','.join(['"' + sub + '"' for sub in headers]) 
-        results = None
-        outdata = []
-        found = False
-
-        for filename in files:
-            rectables = con.sql(f"select * from tables where type = 'records' and warcfile = \'{filename}\';").df().to_dict('records')
-            if len(rectables) == 0:
-                if not silent:
-                    print(f'Records table for {filename} not found. Please reindex')
-                continue
-            else:
-                recfilepath = rectables[0]['path']
-            if not os.path.exists(recfilepath):
-                if not silent:
-                    print(f'Records table file {recfilepath} for {filename} not found. Please reindex or ignore')
-                continue
-            s = f"select {prep_headers} from '{recfilepath}' where warc_id = \'{fileid}\' or url = \'{fileid}\'"
-            results = con.sql(s).fetchall()
-                
-            if results is None or len(results) == 0:                
-                continue
-            else:
-                found = True
-                record = results[0]
-                fileobj = open(record[8], "rb")
-                fileobj.seek(record[0])
-                it = iter(ArchiveIterator(fileobj))
-                warcrec = next(it)
-                filename = record[7] + '.' + get_ext_from_content_type(record[4])
-                if output is None: output = filename
-                out_raw = open(output, 'wb')
-                stream = warcrec.content_stream()
-                buf = stream.read(READ_SIZE)
-                while buf:
-                    out_raw.write(buf)
-                    buf = stream.read(READ_SIZE)
-                out_raw.close()
+        # WARC files indexed before lookup table introduced added on first get
+        ensure_lookup(con)
+        record = find_record(con, fileid)
+        if record is not None:
+            filename = record_filename(record, raw=raw)
+            if output is None: output = filename
+            cache = ContentCache(cache_dir, cache_size) if cache_dir is not None else None
+            with WarcRecordReader(pool_size=1) as reader, reader.open(record[8]) as fileobj, open(output, 'wb') as out_raw:
+                cached = cached_payload(cache, fileobj, record, raw=raw)
+                byte_range = record_range(fileobj, record, raw=raw) if cached is None else None
+                if cached is not None:
+                    with cached:
+                        copy_range(cached, out_raw, 0, os.fstat(cached.fileno()).st_size)
+                elif byte_range is not None:
+                    copy_range(fileobj, out_raw, byte_range[0], byte_range[1])
+                else:
+                    copy_stream(read_record(fileobj, record[0]).content_stream(), out_raw)
+                out_raw.write(record_suffix(record, raw=raw))
             if not silent:
                 print('Wrote %s, url %s' % (filename, record[2]))
-        if not found:
+                if cache is not None:
+                    print(cache.stats().capitalize())
+        else:
             if not silent:
                 print('File not found')
@@ -2,12 +2,15 @@ import json
 import logging
 import os
 import sys
+import struct
 import tempfile
 import zipfile
+import zlib
 
 # from hachoir.core.tools import makePrintable
 from hachoir.metadata import extractMetadata
-from hachoir.parser import createParser
+from hachoir.parser import guessParser
+from hachoir.stream import InputIOStream
 from lxml import etree
 from pdfminer.pdfdocument import PDFDocument
 
@@ -15,15 +18,26 @@ from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfparser import PDFParser
 from warcio import ArchiveIterator
 
+from warcio.utils import BUFF_SIZE
+
 from ..constants import SUPPORTED_FILE_TYPES, MS_XML_FILES, MIME_SHORT_MAP, ADOBE_FILES, IMAGE_FILES, MS_OLE_FILES
 
+READ_SIZE = BUFF_SIZE * 4
+
+# Payloads larger than this size are written to temporary file instead of memory
+DEFAULT_SPILL_SIZE = 32 * 1024 * 1024
+
+XMETA_FILES = ["docProps/core.xml", "docProps/app.xml"]
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+
 
 def extractPDF(filename):
-    """Extracts metadata from Adobe PDF files"""
-    fp = open(filename, "rb")
+    """Extracts metadata from Adobe PDF files. Accepts file name or seekable file object"""
+    fp = open(filename, "rb") if isinstance(filename, str) else filename
     parser = PDFParser(fp)
     try:
-        doc = PDFDocument(parser)
+        # Full file scan only if cross-reference table is broken, metadata taken from trailer
+        doc = PDFDocument(parser, fallback=False)
     except:
         return None
     if len(doc.info) > 0:
@@ -37,37 +51,26 @@ def extractPDF(filename):
     return None
 
 
+def parseXmetaPart(meta, s):
+    """Adds properties from MS Office XML docProps file to metadata dict"""
+    root = etree.fromstring(s)
+    for t in root:
+        meta[t.tag.rsplit("}", 1)[-1]] = t.text
+
+
 def extractXmeta(filename):
-    """Extracts metadata from MS Office XML files like docx, xlsx, e.t.c."""
+    """Extracts metadata from MS Office XML files like docx, xlsx, e.t.c. Accepts file name or seekable file object"""
     try:
         zf = zipfile.ZipFile(filename, "r")
     except zipfile.BadZipFile:
         return None
     meta = {}
     try:
-        try:
-            s = zf.open("docProps/core.xml", "r").read()
-            root = etree.fromstring(s)
-            meta = {}
-            namespaces = {
-                "w":
-                "http://schemas.openxmlformats.org/package/2006/metadata/core-properties"
-            }
-            for t in root:
-                meta[t.tag.rsplit("}", 1)[-1]] = t.text
-        except KeyError:
-            pass
-        try:
-            s = zf.open("docProps/app.xml", "r").read()
-            root = etree.fromstring(s)
-            namespaces = {
-                "w":
-                "http://schemas.openxmlformats.org/officeDocument/2006/extended-properties"
-            }
-            for t in root:
-                meta[t.tag.rsplit("}", 1)[-1]] = t.text
-        except KeyError:
-            pass
+        for name in XMETA_FILES:
+            try:
+                parseXmetaPart(meta, zf.open(name, "r").read())
+            except KeyError:
+                pass
     except KeyboardInterrupt:
         meta = None
     if len(meta.keys()) == 0:
@@ -75,27 +78,132 @@ def extractXmeta(filename):
     return meta
 
 
+def read_exact(stream, size):
+    """Reads exactly size bytes from stream or less if stream ended"""
+    chunks = []
+    while size > 0:
+        buf = stream.read(min(size, READ_SIZE))
+        if not buf:
+            break
+        chunks.append(buf)
+        size -= len(buf)
+    return b"".join(chunks)
+
+
+def skip_bytes(stream, size):
+    """Reads and drops size bytes from stream"""
+    while size > 0:
+        buf = stream.read(min(size, READ_SIZE))
+        if not buf:
+            break
+        size -= len(buf)
+
+
+def streamXmeta(stream):
+    """Extracts metadata from MS Office XML file read sequentially from stream. Reads zip entries one by one
+    and stops right after docProps files found. Raises ValueError if zip entries sizes not known in advance"""
+    parts = {}
+    is_zip = False
+    while len(parts) < len(XMETA_FILES):
+        header = read_exact(stream, ZIP_LOCAL_HEADER.size)
+        if len(header) < ZIP_LOCAL_HEADER.size or header[:4] != b"PK\x03\x04":
+            break
+        is_zip = True
+        (_, _, flag, method, _, _, _, csize, _, nlen, xlen) = ZIP_LOCAL_HEADER.unpack(header)
+        name = read_exact(stream, nlen).decode("utf8", "ignore")
+        read_exact(stream, xlen)
+        if flag & 0x08 or csize == 0xFFFFFFFF:
+            raise ValueError("Size of zip entry %s not known from local header" % name)
+        if name not in XMETA_FILES:
+            skip_bytes(stream, csize)
+            continue
+        data = read_exact(stream, csize)
+        if method == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        elif method != zipfile.ZIP_STORED:
+            raise ValueError("Unsupported compression of zip entry %s" % name)
+        parts[name] = data
+    if not is_zip:
+        return None
+    meta = {}
+    for name in XMETA_FILES:
+        if name in parts.keys():
+            parseXmetaPart(meta, parts[name])
+    if len(meta.keys()) == 0:
+        meta = None
+    return meta
+
+
+class TeeReader:
+    """Reads stream and copies everything read to another file object"""
+
+    def __init__(self, stream, copy):
+        self.stream = stream
+        self.copy = copy
+
+    def read(self, size=-1):
+        buf = self.stream.read(size)
+        self.copy.write(buf)
+        return buf
+
+
+def read_payload(record, spill_size=DEFAULT_SPILL_SIZE, stream=None, payload=None):
+    """Reads WARC record payload into memory, payloads larger than spill size written to temporary file
+    removed on close. Continues reading of already started stream if stream and payload provided. Returns seekable file object"""
+    if payload is None:
+        payload = tempfile.SpooledTemporaryFile(max_size=spill_size, dir=tempfile.gettempdir())
+    if stream is None:
+        stream = record.content_stream()
+    buf = stream.read(READ_SIZE)
+    while buf:
+        payload.write(buf)
+        buf = stream.read(READ_SIZE)
+    payload.seek(0)
+    return payload
+
+
+def get_ext(mime, filename):
+    """Returns file extension by mime type or file name"""
+    if mime and mime in MIME_SHORT_MAP.keys():
+        return MIME_SHORT_MAP[mime]
+    return filename.rsplit(".", 1)[-1]
+
+
 def processWarcRecord(record,
                       url,
                       filename,
                       mime=None, source=None,
                       fields=None,
-                      debug=False):
+                      debug=False,
+                      spill_size=DEFAULT_SPILL_SIZE):
     """Processes single WARC record"""
-    if mime and mime in MIME_SHORT_MAP.keys():
-        ext = MIME_SHORT_MAP[mime]
-    else:
-        ext = filename.rsplit(".", 1)[-1]
-    temp = tempfile.NamedTemporaryFile(
-        suffix=ext,
-        dir=tempfile.gettempdir(),
-        mode="wb",
-        delete=False if debug else False,
-    )
-#    temp.write(record.raw_stream.read())
-    temp.write(record.content_stream().read())
-    temp.close()
-    result = {
+    ext = get_ext(mime, filename)
+    if record.payload_length != 0 and (ext in MS_XML_FILES or (mime in MIME_SHORT_MAP.keys()
+                                                                and MIME_SHORT_MAP[mime] in MS_XML_FILES)):
+        # Zip entries read until docProps files found, already read part of payload kept to parse whole file if it's not possible
+        stream = record.content_stream()
+        payload = tempfile.SpooledTemporaryFile(max_size=spill_size, dir=tempfile.gettempdir())
+        try:
+            try:
+                result = baseResult(url, filename, ext, mime=mime, source=source)
+                result["metadata"] = streamXmeta(TeeReader(stream, payload))
+                return result
+            except (ValueError, zlib.error) as err:
+                logging.debug("Unable to read %s sequentially: %s" % (url, str(err)))
+                read_payload(record, stream=stream, payload=payload)
+                return processPayload(payload, record.payload_length, url, filename, ext, mime=mime, source=source)
+        finally:
+            payload.close()
+    payload = read_payload(record, spill_size=spill_size)
+    try:
+        return processPayload(payload, record.payload_length, url, filename, ext, mime=mime, source=source)
+    finally:
+        payload.close()
+
+
+def baseResult(url, filename, ext, mime=None, source=None):
+    """Returns metadata extraction result without metadata"""
+    return {
         "source" : source,
         "filename": filename,
         "ext": ext,
@@ -104,22 +212,27 @@ def processWarcRecord(record,
         "metadata": None,
         "error": False,
     }
-    if record.payload_length == 0:
+
+
+def processPayload(payload, payload_length, url, filename, ext, mime=None, source=None):
+    """Extracts metadata from WARC record payload file object"""
+    result = baseResult(url, filename, ext, mime=mime, source=source)
+    if payload_length == 0:
         result["error"] = True
         result["msg"] = "Zero length file %s. Skip" % (filename)
         logging.info("Zero length file %s. Skip" % (filename))
         return result
     if ext in MS_XML_FILES or (mime in MIME_SHORT_MAP.keys()
                                and MIME_SHORT_MAP[mime] in MS_XML_FILES):
-        meta = extractXmeta(temp.name)
+        meta = extractXmeta(payload)
         result["metadata"] = meta
     elif ext in ADOBE_FILES or (mime in MIME_SHORT_MAP.keys()
                                 and MIME_SHORT_MAP[mime] in ADOBE_FILES):
-        meta = extractPDF(temp.name)
+        meta = extractPDF(payload)
         result["metadata"] = meta
     else:
         try:
-            parser = createParser(temp.name)
+            parser = guessParser(InputIOStream(payload, source='warc:' + url, tags=[('filename', filename)]))
         except KeyboardInterrupt:
             result["error"] = True
             result["msg"] = "Unable to parse file %s" % filename
@@ -11,9 +11,11 @@ import pyarrow as pa
 from io import BytesIO
 import glob
 import tqdm
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import repeat
 
 #from lxml import etree, html
-from bs4 import BeautifulSoup,SoupStrainer
 
 from ..constants import SUPPORTED_FILE_TYPES, IMAGE_FILES, MS_XML_FILES, MIME_SHORT_MAP, ADOBE_FILES, MS_OLE_FILES, HTML_FILES, MIMES_EXT_TYPE_BY_GROUP
 
@@ -24,7 +26,15 @@ from pdfminer.pdfdocument import PDFDocument
 # from hachoir.core.i18n import initLocale
 from pdfminer.pdfparser import PDFParser
 
-from .extractor import processWarcRecord
+from .extractor import processWarcRecord, processPayload, get_ext, DEFAULT_SPILL_SIZE
+from .payload import open_payload, payload_stream
+from .reader import WarcRecordReader, read_record
+from .cache import ContentCache, DEFAULT_CACHE_SIZE
+from .links import extract_links, resolve_links, get_link_extractor, DEFAULT_LINKS_ENGINE
+from .writer import TableWriter, TableLayout, merge_tables, RECORDS_SCHEMA, HEADERS_SCHEMA, LINKS_SCHEMA, DEFAULT_BATCH_SIZE
+from .scanner import split_ranges, open_head_scanner, cdx_records_sql
+from .catalog import update_lookup, update_stats, refresh_stats, parquet_scan, ensure_catalog, release_shared, file_fingerprint, file_checksum
+from .dataset import Dataset, table_exists, remove_table, mime_group, is_partitioned
 
 
 BUFF_SIZE = 16384
@@ -32,6 +42,15 @@ READ_SIZE = BUFF_SIZE * 4
 
 THRESHOLD = 250
 
+# Number of records sent to metadata extraction worker process at once
+EXTRACT_CHUNK_SIZE = 64
+
+# Gzipped WARC files larger than this size split into byte ranges indexed in parallel
+DEFAULT_SPLIT_SIZE = 1024 * 1024 * 1024
+
+# WARC files larger than this size indexed by chunks, each chunk saved as checkpoint
+DEFAULT_CHECKPOINT_SIZE = 1024 * 1024 * 1024
+
 def bufcount(filename):
     """Count number of lines"""
     f = open(filename)                  
@@ -50,9 +69,6 @@ def cdx_size_counter(filename):
     return bufcount(filename) - 1
 
 
-DEFAULT_LINK_ATTRS = ['href', 'class', 'id']
-
-
 ALL_TABLES = ['records', 'headers','links', 'oledocs', 'ooxmldocs', 'images', 'pdfs']
 
 def dump_table(filename:str, table:list, con=None):    
@@ -65,143 +81,523 @@ def dump_table(filename:str, table:list, con=None):
         duckdb.sql(query)
 
 
+def register_tables(con, list_files:list, list_tables:list):
+    """Inserts indexed files and their parquet tables into files and tables catalog as one batch"""
+    ensure_catalog(con)
+    if len(list_files) > 0:
+        pa_files = pa.Table.from_pylist(list_files)
+        con.sql("INSERT OR REPLACE INTO files (filename, filesize, num_records, mtime, checksum) SELECT filename, filesize, num_records, mtime, checksum FROM pa_files")
+    if len(list_tables) == 0:
+        return
+    released = release_shared(con, list_tables)
+    pa_tables = pa.Table.from_pylist(list_tables)
+    con.sql("INSERT OR REPLACE INTO tables SELECT * FROM pa_tables")
+    for path in released:
+        remove_table(path)
+
+
+def get_cdx_filename(filename:str):
+    """Returns name of CDX or CDXJ file accompanying WARC file. Name of CDX file returned if none of them exists"""
+    base = filename.rsplit('.', 2)[0]
+    for ext in ['.warc.gz', '.warc']:
+        if filename.lower().endswith(ext):
+            base = filename[:-len(ext)]
+            break
+    for ext in ['.cdx', '.cdxj']:
+        if os.path.exists(base + ext):
+            return base + ext
+    return base + '.cdx'
+
+
+def load_checkpoint(filename:str, fromfile:str):
+    """Returns saved indexing state of WARC file or None if checkpoint file not exists, broken or belongs to other WARC file"""
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'r', encoding='utf8') as f:
+            state = json.load(f)
+    except ValueError:
+        logging.info('Broken checkpoint file %s ignored' % filename)
+        return None
+    if not isinstance(state, dict) or os.path.abspath(state.get('filename') or '') != os.path.abspath(fromfile):
+        logging.info('Checkpoint file %s of other WARC file ignored' % filename)
+        return None
+    return state
+
+
+def save_checkpoint(filename:str, state:dict):
+    """Saves indexing state, file replaced at once so it's never partially written"""
+    tempname = filename + '.tmp'
+    with open(tempname, 'w', encoding='utf8') as f:
+        json.dump(state, f)
+    os.replace(tempname, filename)
+
+
+def index_warc_file(fromfile:str, tables:list, rescan:bool=False, batch_size:int=DEFAULT_BATCH_SIZE, layout:TableLayout=None, dataset:Dataset=None, checkpoint_size:int=DEFAULT_CHECKPOINT_SIZE, fast_scan:bool=False):
+    """Worker function to index single WARC file in separate process"""
+    return Indexer(dataset).index_file(fromfile, tables, rescan=rescan, silent=True, batch_size=batch_size, layout=layout, checkpoint_size=checkpoint_size, fast_scan=fast_scan)
+
+
+def index_warc_range(fromfile:str, tables:list, start:int, end:int, part:int, batch_size:int=DEFAULT_BATCH_SIZE, dataset:Dataset=None, fast_scan:bool=False):
+    """Worker function to index byte range of WARC file in separate process"""
+    return Indexer(dataset).index_range(fromfile, tables, start, end, part, batch_size=batch_size, fast_scan=fast_scan)
+
+
+def record_links(item:dict, filename:str, content:bytes, links_engine:str=DEFAULT_LINKS_ENGINE):
+    """Extracts links from HTML page content. Returns list of items"""
+    list_items = []
+    try:
+        links = resolve_links(item['url'], extract_links(content, engine=links_engine))
+        for link in links:
+            lrec = {'warc_id' : item['warc_id'], 'source' : filename, 'url' : item['url']}
+            lrec.update(link)
+            list_items.append(lrec)
+    except KeyboardInterrupt:
+        pass
+    except ValueError:
+        logging.info('Error parsing links from %s' % (item['url']))
+        pass
+    return list_items
+
+
+def extract_record(warcf, item:dict, filename:str, table_type:str, spill_size:int=DEFAULT_SPILL_SIZE, links_engine:str=DEFAULT_LINKS_ENGINE, cache:ContentCache=None):
+    """Reads WARC record at item offset and extracts links or file metadata from it. Returns list of items.
+    With cache payload read from cache or extracted to it"""
+    list_items = []
+    offset = int(item['offset'])
+    if cache is not None and item['warc_id']:
+        with cache.fetch(item['warc_id'], lambda: payload_stream(warcf, offset)) as payload:
+            if table_type == 'links':
+                return record_links(item, filename, payload.read(), links_engine)
+            ext = get_ext(item['c_type'], filename)
+            list_items.append(processPayload(payload, os.fstat(payload.fileno()).st_size, item['url'], filename, ext, mime=item['c_type'], source=filename))
+        return list_items
+    if table_type != 'links':
+        # Payload of uncompressed WARC record read lazily, only byte ranges requested by metadata parser
+        payload = open_payload(warcf, offset)
+        if payload is not None:
+            reader, payload_length = payload
+            ext = get_ext(item['c_type'], filename)
+            list_items.append(processPayload(reader, payload_length, item['url'], filename, ext, mime=item['c_type'], source=filename))
+            return list_items
+    dbrec = read_record(warcf, offset)
+    if table_type == 'links':
+        out_raw = BytesIO()
+        stream = dbrec.content_stream()
+        buf = stream.read(READ_SIZE)
+        while buf:
+            out_raw.write(buf)
+            buf = stream.read(READ_SIZE)
+        list_items.extend(record_links(item, filename, out_raw.getvalue(), links_engine))
+    else:
+        list_items.append(processWarcRecord(dbrec, item['url'], filename, mime=item['c_type'], source=filename, spill_size=spill_size))
+    return list_items
+
+
+def extract_records(filename:str, items:list, spill_size:int=DEFAULT_SPILL_SIZE, links_engine:str=DEFAULT_LINKS_ENGINE):
+    """Worker function to extract links or file metadata from list of records of WARC file in separate process.
+    Returns list of extracted items for each record and numbers of cache hits and misses of these records"""
+    results = []
+    reader = worker_reader if worker_reader is not None else WarcRecordReader(pool_size=1)
+    cache = worker_cache
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    with reader.open(filename) as warcf:
+        for item in items:
+            results.append(extract_record(warcf, item, filename, item['table_type'], spill_size, links_engine, cache))
+    if reader is not worker_reader:
+        reader.close()
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    return results, hits, misses
+
+
+# WARC files of worker process mapped once for all chunks sent to it, cache size counted once
+worker_reader = None
+worker_cache = None
+
+
+def init_extract_worker(cache_dir:str=None, cache_size:int=DEFAULT_CACHE_SIZE):
+    """Initializes metadata extraction worker process"""
+    global worker_reader, worker_cache
+    from hachoir.core import config as HachoirConfig
+    HachoirConfig.quiet = True
+    worker_reader = WarcRecordReader()
+    worker_cache = ContentCache(cache_dir, cache_size) if cache_dir is not None else None
+
+
 class Indexer:
     """Indexes WARC file metadata"""
 
-    def __init__(self):
-        pass
+    def __init__(self, dataset:Dataset=None):
+        self.dataset = dataset if dataset is not None else Dataset()
 
-    def index_records(self, fromfiles:list, tofile:str='warcindex.db', tables:list=['records', 'headers'], rescan:bool=False, silent:bool=False):
-        """Generates DuckDB database and parquet files as WARC index"""
-        from rich.progress import track
+    def skip_file(self, table_filename:str, rescan:bool=False, silent:bool=False):
+        """Checks if WARC file already indexed and should be skipped"""
         from rich import print
-        
-        real_tables = ALL_TABLES.copy() if tables is None or 'all' in tables else tables
-        
-        con = duckdb.connect(tofile)
-        list_files = []
-        list_tables = []
-        glob_tables = [x[0] for x in con.sql('show tables').fetchall()]
 
-        for fromfile in fromfiles:
-            file_record = {'filename' : fromfile, 'filesize' : os.path.getsize(fromfile)}
-            logging.debug("Indexing %s" % fromfile)
-            resp = open(fromfile, "rb")  
-            file_basename = os.path.basename(fromfile).lower()
-            if file_basename[-5:] == '.warc': 
-                file_basename - file_basename[0:-5]
-            elif file_basename[-8:] == '.warc.gz': 
-                file_basename = file_basename[0:-8]
-
-            table_filename = 'data/' + file_basename + f'_records.parquet'
-            if os.path.exists(table_filename):
-                if not rescan:
-                    if not silent:
-                        print('Fole {table_filename} already exists and rescan option not set. Skipping')
-                        continue
-                else:
-                    if not silent:
-                        print('Fole {table_filename} already exists but rescan option set. Processing')                
-
-            iterator = ArchiveIterator(resp)
-                            
-            cdx_filename = fromfile.rsplit('.', 2)[0] + '.cdx'
-            records_num = -1
-            if os.path.exists(cdx_filename):
-                records_num = cdx_size_counter(cdx_filename)
+        if table_exists(table_filename):
+            if not rescan:
                 if not silent:
-                    print('CDX file found. Estimated number of WARC records %d' % (records_num))
+                    print(f'File {table_filename} already exists and rescan option not set. Skipping')
+                return True
             else:
                 if not silent:
-                    print("No CDX file. Can't measure progress")
-            n = 0 
-            list_records = []
-            list_headers = []
-
-            it = iterator if silent else tqdm.tqdm(iterator, desc='Iterate records', total=records_num*2)
-            for record in it:
-                if record.rec_type != "response": continue
-
-                n += 1      
-#                if not silent:
-#                    if records_> 0:
-#                        if n % THRESHOLD == 0: print('Processed %d (%0.2f%%) records' % (n, n*100.0 / records_num))            
-#                    else:
-#                        if n % THRESHOLD == 0: print('Processed %d records' % (n))
-                if record.http_headers is not None:
-                    dbrec = {}
-                    dbrec['warc_id'] = record.rec_headers["WARC-Record-ID"].rsplit(':', 1)[-1].strip('>')
-                    dbrec['url'] = record.rec_headers["WARC-Target-URI"]
-                    content_type = record.http_headers["content-type"] if 'content-type' in record.http_headers else None
-                    dbrec['content_type'] = content_type
-                    charset = None
-                    content_type_no_ch = content_type
-                    if content_type is not None and content_type.find(';') > -1:
-                        content_type_no_ch, charset = content_type.split(';', 1)
-                        content_type_no_ch = content_type_no_ch.strip().lower()
-                        if charset.find('=') > -1:
-                            charset = charset.split('=', 1)[-1].lower().strip()
-
-
-                    filename = dbrec['url'].rsplit("?", 1)[0].rsplit("/", 1)[-1].lower()
-                    ext = filename.rsplit(".", 1)[-1]
-
-                    dbrec['c_type'] = content_type_no_ch
-                    dbrec['c_type_charset'] = charset
-                    dbrec['offset'] = it.iterable.get_record_offset()
-                    dbrec['length'] = it.iterable.get_record_length()
-                    warc_date  = record.rec_headers["WARC-Date"]
-                    dbrec['rec_date'] = datetime.strptime(warc_date, "%Y-%m-%dT%H:%M:%S%z")
-                    dbrec['content_length'] = int(record.rec_headers["Content-Length"])
-                    dbrec['status_code'] = int(record.http_headers.statusline.split(' ', 1)[0])                
-                    dbrec['source'] = fromfile
-                    dbrec['filename'] = dbrec['url'].rsplit("?", 1)[0].rsplit("/", 1)[-1].lower() 
-                    dbrec['ext'] = dbrec['filename'].rsplit(".", 1)[-1] if dbrec['filename'].find(".") > -1 else ""
-                    properties = []
-                    if 'records' in real_tables:
-                        list_records.append(dbrec)
-                    if 'headers' in real_tables:
-                        for key, value in record.http_headers.headers:
-                            properties.append({'key' : key, 'value' : value, 'warc_id' : dbrec['warc_id'], 'source': fromfile})
-                        list_headers.extend(properties)        
+                    print(f'File {table_filename} already exists but rescan option set. Processing')
+        return False
 
+    def changed_files(self, con, fromfiles:list, tables:list=['records', 'headers'], rescan:bool=False, checksum:bool=False, silent:bool=False):
+        """Returns new or changed WARC files and fingerprints of them. WARC file not changed if it's size and modification time
+        are the same as in files catalog and it's records and headers tables exist if requested. With checksum option files
+        with changed modification time but same checksum also not changed"""
+        from rich import print
+        known = {}
+        paths = {}
+        if con is not None:
+            ensure_catalog(con)
+            known = {row[0] : row[1:] for row in con.sql('select filename, filesize, mtime, checksum, num_records from files').fetchall()}
+            paths = {(row[0], row[1]) : row[2] for row in con.sql("select warcfile, type, path from tables where type in ('records', 'headers')").fetchall()}
+        required = [table_type for table_type in ['records', 'headers'] if table_type in tables]
+        existing = {}
+        changed = []
+        fingerprints = {}
+        for fromfile in fromfiles:
+            fingerprint = file_fingerprint(fromfile)
+            fingerprints[fromfile] = fingerprint
+            if not rescan and fromfile in known.keys():
+                filesize, mtime, stored_checksum, num_records = known[fromfile]
+                same = filesize == fingerprint['filesize'] and mtime == fingerprint['mtime']
+                if not same and checksum and stored_checksum is not None and filesize == fingerprint['filesize']:
+                    fingerprint['checksum'] = file_checksum(fromfile, fingerprint['filesize'])
+                    if fingerprint['checksum'] == stored_checksum:
+                        # file touched or copied, content is the same
+                        con.execute('UPDATE files SET mtime = ? WHERE filename = ?', [fingerprint['mtime'], fromfile])
+                        same = True
+                missing = None
+                if same and num_records > 0:
+                    for table_type in required:
+                        path = paths.get((fromfile, table_type))
+                        if path is not None and path not in existing.keys():
+                            existing[path] = table_exists(path)
+                        if path is None or not existing[path]:
+                            missing = table_type
+                            break
+                if same and missing is None:
+                    if not silent:
+                        print(f'{fromfile} not changed since last indexing. Skipping')
+                    continue
+                if not silent:
+                    if missing is not None:
+                        print(f'{fromfile} has no {missing} table. Processing')
+                    else:
+                        print(f'{fromfile} changed since last indexing. Processing')
+            if checksum and fingerprint['checksum'] is None:
+                fingerprint['checksum'] = file_checksum(fromfile, fingerprint['filesize'])
+            changed.append(fromfile)
+        return changed, fingerprints
+
+    def write_record(self, fromfile:str, rec_headers, http_headers, offset:int, length:int, records_writer:TableWriter=None, headers_writer:TableWriter=None):
+        """Writes WARC response record to records table and it's HTTP headers to headers table"""
+        dbrec = {}
+        dbrec['warc_id'] = rec_headers["WARC-Record-ID"].rsplit(':', 1)[-1].strip('>')
+        dbrec['url'] = rec_headers["WARC-Target-URI"]
+        content_type = http_headers["content-type"] if 'content-type' in http_headers else None
+        dbrec['content_type'] = content_type
+        charset = None
+        content_type_no_ch = content_type
+        if content_type is not None and content_type.find(';') > -1:
+            content_type_no_ch, charset = content_type.split(';', 1)
+            content_type_no_ch = content_type_no_ch.strip().lower()
+            if charset.find('=') > -1:
+                charset = charset.split('=', 1)[-1].lower().strip()
+
+        dbrec['c_type'] = content_type_no_ch
+        dbrec['c_type_charset'] = charset
+        dbrec['offset'] = offset
+        dbrec['length'] = length
+        warc_date  = rec_headers["WARC-Date"]
+        dbrec['rec_date'] = datetime.strptime(warc_date, "%Y-%m-%dT%H:%M:%S%z")
+        dbrec['content_length'] = int(rec_headers["Content-Length"])
+        dbrec['status_code'] = int(http_headers.statusline.split(' ', 1)[0])
+        dbrec['source'] = fromfile
+        dbrec['filename'] = dbrec['url'].rsplit("?", 1)[0].rsplit("/", 1)[-1].lower()
+        dbrec['ext'] = dbrec['filename'].rsplit(".", 1)[-1] if dbrec['filename'].find(".") > -1 else ""
+        if records_writer is not None:
+            records_writer.write(dbrec)
+        if headers_writer is not None:
+            for key, value in http_headers.headers:
+                headers_writer.write({'key' : key, 'value' : value, 'warc_id' : dbrec['warc_id'], 'source': fromfile})
+
+    def scan_records(self, fromfile:str, records_writer:TableWriter=None, headers_writer:TableWriter=None, start:int=0, end:int=None, silent:bool=True, total:int=-1):
+        """Reads only headers of WARC response records from start offset to end offset, payloads are skipped.
+        Returns offset of first record after end offset, None if file read till the end or False if fast scan not possible
+        for gzipped file without CDX file. Records after record which could not be parsed read by warcio"""
+        resp = open(fromfile, "rb")
+        scanner = open_head_scanner(resp, fromfile, start, end, get_cdx_filename(fromfile))
+        if scanner is None:
             resp.close()
+            return False
+
+        it = scanner if silent else tqdm.tqdm(scanner, desc='Scan records', total=total)
+        for offset, length, head in it:
+            if head['rec_headers'].get_header('WARC-Type') != "response": continue
+            if head['http_headers'] is not None:
+                self.write_record(fromfile, head['rec_headers'], head['http_headers'], offset, length, records_writer, headers_writer)
+        resp.close()
+        if scanner.failed_offset is not None:
+            logging.info('Fast scan of %s stopped at offset %d, reading rest of file by warcio' % (fromfile, scanner.failed_offset))
+            return self.iterate_records(fromfile, records_writer, headers_writer, start=scanner.failed_offset, end=end, silent=silent)
+        return scanner.next_offset
+
+    def iterate_records(self, fromfile:str, records_writer:TableWriter=None, headers_writer:TableWriter=None, start:int=0, end:int=None, silent:bool=True, total:int=-1, fast_scan:bool=False):
+        """Reads WARC response records from start offset to end offset and writes them to records and headers writers.
+        With fast scan option only headers of records read if possible.
+        Returns offset of first record after end offset or None if file read till the end"""
+        if fast_scan:
+            next_offset = self.scan_records(fromfile, records_writer, headers_writer, start=start, end=end, silent=silent, total=total)
+            if next_offset is not False:
+                return next_offset
+        resp = open(fromfile, "rb")
+        resp.seek(start)
+        iterator = ArchiveIterator(resp)
+        next_offset = None
+
+        it = iterator if silent else tqdm.tqdm(iterator, desc='Iterate records', total=total)
+        for record in it:
+            if end is not None and iterator.get_record_offset() >= end:
+                next_offset = iterator.get_record_offset()
+                break
+            if record.rec_type != "response": continue
+
+            if record.http_headers is not None:
+                self.write_record(fromfile, record.rec_headers, record.http_headers, iterator.get_record_offset(), iterator.get_record_length(), records_writer, headers_writer)
+
+        resp.close()
+        return next_offset
+
+    def index_file(self, fromfile:str, tables:list=['records', 'headers'], rescan:bool=False, silent:bool=False, batch_size:int=DEFAULT_BATCH_SIZE, layout:TableLayout=None, checkpoint_size:int=DEFAULT_CHECKPOINT_SIZE, fast_scan:bool=False):
+        """Indexes single WARC file and writes it's parquet files. Returns file record and list of written tables"""
+        from rich import print
 
-            os.makedirs('data', exist_ok=True)
-            if 'records' in real_tables:               
-                if len(list_records) > 0: 
-                    dump_table(filename=table_filename, table=list_records, con=con)
-                    list_tables.append({'warcfile' : fromfile, 'path' :table_filename, 'type' : 'records', 'num_items' : len(list_records)})
-                    if not silent:
-                        print('- saved %s with %s' % (table_filename, 'records'))
-            if 'headers' in real_tables:
-                if len(list_headers) > 0:
-                    dump_table(filename='data/' +file_basename + '_headers.parquet', table=list_headers, con=con)
-                    list_tables.append({'warcfile' : fromfile, 'path' :'data/' + file_basename + '_headers.parquet', 'type' : 'headers', 'num_items' : len(list_headers)})
+        real_tables = ALL_TABLES.copy() if tables is None or 'all' in tables else tables
+
+        logging.debug("Indexing %s" % fromfile)
+        table_filename = self.dataset.table_path(fromfile, 'records')
+        if self.skip_file(table_filename, rescan=rescan, silent=silent):
+            return None
+        headers_filename = self.dataset.table_path(fromfile, 'headers')
+
+        if checkpoint_size and os.path.getsize(fromfile) > checkpoint_size:
+            num_records, num_headers = self.index_with_checkpoints(fromfile, real_tables, checkpoint_size, silent=silent, batch_size=batch_size, layout=layout, fast_scan=fast_scan)
+            return self.file_result(fromfile, table_filename, num_records, headers_filename, num_headers)
+
+        cdx_filename = get_cdx_filename(fromfile)
+        records_num = -1
+        if os.path.exists(cdx_filename):
+            records_num = cdx_size_counter(cdx_filename)
+            if not silent:
+                print('CDX file found. Estimated number of WARC records %d' % (records_num))
+        else:
+            if not silent:
+                print("No CDX file. Can't measure progress")
+        records_writer = self.dataset.open_writer(fromfile, 'records', RECORDS_SCHEMA, batch_size=batch_size, layout=layout) if 'records' in real_tables else None
+        headers_writer = self.dataset.open_writer(fromfile, 'headers', HEADERS_SCHEMA, batch_size=batch_size, layout=layout) if 'headers' in real_tables else None
+
+        self.iterate_records(fromfile, records_writer, headers_writer, silent=silent, total=records_num*2, fast_scan=fast_scan)
+
+        num_records = records_writer.close() if records_writer is not None else 0
+        num_headers = headers_writer.close() if headers_writer is not None else 0
+        return self.file_result(fromfile, table_filename, num_records, headers_filename, num_headers)
+
+    def index_cdx(self, fromfile:str, silent:bool=False, batch_size:int=DEFAULT_BATCH_SIZE, layout:TableLayout=None):
+        """Writes records table of WARC file from it's CDX or CDXJ file without reading WARC file.
+        Returns file record and list of written tables or None if CDX file not found"""
+        from rich import print
+        cdx_filename = get_cdx_filename(fromfile)
+        if not os.path.exists(cdx_filename):
+            return None
+        table_filename = self.dataset.table_path(fromfile, 'records')
+        headers_filename = self.dataset.table_path(fromfile, 'headers')
+        con = duckdb.connect()
+        reader = con.sql(cdx_records_sql(cdx_filename, fromfile)).to_arrow_reader(batch_size)
+        writer = self.dataset.open_writer(fromfile, 'records', RECORDS_SCHEMA, batch_size=batch_size, layout=layout)
+        with writer:
+            for batch in reader:
+                for casted in pa.Table.from_batches([batch]).cast(RECORDS_SCHEMA).to_batches():
+                    writer.write_batch(casted)
+        con.close()
+        if not silent:
+            print('Read %d records of %s from %s' % (writer.num_rows, fromfile, cdx_filename))
+        return self.file_result(fromfile, table_filename, writer.num_rows, headers_filename, 0)
+
+    def index_with_checkpoints(self, fromfile:str, tables:list, checkpoint_size:int, silent:bool=False, batch_size:int=DEFAULT_BATCH_SIZE, layout:TableLayout=None, fast_scan:bool=False):
+        """Indexes WARC file by chunks of checkpoint size. Each chunk written to part files and offset of next record saved to checkpoint file,
+        so interrupted indexing continues from last checkpoint. Parts merged when whole file indexed. Returns number of records and headers"""
+        from rich import print
+        os.makedirs(self.dataset.root, exist_ok=True)
+        checkpoint_filename = self.dataset.checkpoint_path(fromfile)
+        fingerprint = file_fingerprint(fromfile)
+        state = load_checkpoint(checkpoint_filename, fromfile)
+        if state is None or state['filesize'] != fingerprint['filesize'] or state['mtime'] != fingerprint['mtime'] or state['tables'] != tables:
+            state = {'filename' : fromfile, 'filesize' : fingerprint['filesize'], 'mtime' : fingerprint['mtime'], 'tables' : tables, 'offset' : 0, 'parts' : 0}
+        elif not silent:
+            print('Checkpoint found. Continue indexing %s from offset %d' % (fromfile, state['offset'] if state['offset'] is not None else fingerprint['filesize']))
+
+        schemas = [(table, schema) for table, schema in [('records', RECORDS_SCHEMA), ('headers', HEADERS_SCHEMA)] if table in tables]
+        progress = None
+        if not silent and state['offset'] is not None:
+            progress = tqdm.tqdm(desc='Index WARC file', total=fingerprint['filesize'], initial=state['offset'], unit='B', unit_scale=True)
+        while state['offset'] is not None:
+            writers = {table : TableWriter(self.dataset.part_path(fromfile, table, state['parts']), schema, batch_size=batch_size) for table, schema in schemas}
+            next_offset = self.iterate_records(fromfile, writers.get('records'), writers.get('headers'), start=state['offset'], end=state['offset'] + checkpoint_size, fast_scan=fast_scan)
+            for writer in writers.values():
+                writer.close()
+            if progress is not None:
+                progress.update((next_offset if next_offset is not None else fingerprint['filesize']) - state['offset'])
+            state['parts'] += 1
+            state['offset'] = next_offset
+            save_checkpoint(checkpoint_filename, state)
+        if progress is not None:
+            progress.close()
+
+        # parts kept until all tables merged, so merge could be repeated if interrupted
+        counts = {}
+        parts = {}
+        for table, schema in schemas:
+            parts[table] = [self.dataset.part_path(fromfile, table, part) for part in range(state['parts'])]
+            writer = self.dataset.open_writer(fromfile, table, schema, batch_size=batch_size, layout=layout)
+            counts[table] = merge_tables(parts[table], writer, batch_size=batch_size, keep=True)
+        os.remove(checkpoint_filename)
+        for table_parts in parts.values():
+            for part in table_parts:
+                if os.path.exists(part):
+                    os.remove(part)
+        return counts.get('records', 0), counts.get('headers', 0)
+
+    def file_result(self, fromfile:str, table_filename:str, num_records:int, headers_filename:str, num_headers:int):
+        """Returns file record and list of written tables for indexed WARC file"""
+        list_tables = []
+        if num_records > 0:
+            list_tables.append({'warcfile' : fromfile, 'path' :table_filename, 'type' : 'records', 'num_items' : num_records})
+        if num_headers > 0:
+            list_tables.append({'warcfile' : fromfile, 'path' : headers_filename, 'type' : 'headers', 'num_items' : num_headers})
+        file_record = {'filename' : fromfile, 'num_records' : num_records}
+        file_record.update(file_fingerprint(fromfile))
+        return file_record, list_tables
+
+    def index_range(self, fromfile:str, tables:list, start:int, end:int, part:int, batch_size:int=DEFAULT_BATCH_SIZE, fast_scan:bool=False):
+        """Indexes byte range of WARC file into numbered part files. Returns paths of part files"""
+        real_tables = ALL_TABLES.copy() if tables is None or 'all' in tables else tables
+        os.makedirs(self.dataset.root, exist_ok=True)
+        result = {}
+        writers = {}
+        for table, schema in [('records', RECORDS_SCHEMA), ('headers', HEADERS_SCHEMA)]:
+            if table in real_tables:
+                result[table] = self.dataset.part_path(fromfile, table, part)
+                writers[table] = TableWriter(result[table], schema, batch_size=batch_size)
+        self.iterate_records(fromfile, writers.get('records'), writers.get('headers'), start=start, end=end, fast_scan=fast_scan)
+        for writer in writers.values():
+            writer.close()
+        return result
+
+    def index_records(self, fromfiles:list, tofile:str='warcindex.db', tables:list=['records', 'headers'], rescan:bool=False, silent:bool=False, workers:int=1, batch_size:int=DEFAULT_BATCH_SIZE, split_size:int=DEFAULT_SPLIT_SIZE, layout:TableLayout=None, checksum:bool=False, checkpoint_size:int=DEFAULT_CHECKPOINT_SIZE, fast_scan:bool=False, from_cdx:bool=False):
+        """Generates DuckDB database and parquet files as WARC index. WARC files larger than checkpoint size indexed with checkpoints.
+        With from_cdx option records tables written from CDX files, headers tables added when WARC files indexed without this option"""
+        from rich import print
+
+        list_files = []
+        list_tables = []
+        results = []
+
+        # Only new and changed WARC files indexed, their previous tables replaced
+        con = duckdb.connect(tofile) if os.path.exists(tofile) else None
+        check_tables = ['records'] if from_cdx else (ALL_TABLES if tables is None or 'all' in tables else tables)
+        fromfiles, fingerprints = self.changed_files(con, fromfiles, tables=check_tables, rescan=rescan, checksum=checksum, silent=silent)
+        if con is not None:
+            con.close()
+
+        if from_cdx:
+            warcfiles = []
+            for fromfile in fromfiles:
+                result = self.index_cdx(fromfile, silent=silent, batch_size=batch_size, layout=layout)
+                if result is None:
                     if not silent:
-                        print('- saved %s with %s' % ('data/' + file_basename + '_headers.parquet', 'headers'))
-            file_record['num_records'] = len(list_records)
+                        print(f'No CDX file for {fromfile}. Reading WARC file')
+                    warcfiles.append(fromfile)
+                    continue
+                results.append(result)
+            fromfiles = warcfiles
+
+        if workers > 1:
+            # Each WARC file indexed in it's own process, large gzipped WARC files split by gzip member boundaries
+            # and their byte ranges indexed concurrently. Catalog updated once by parent process
+            file_ranges = {}
+            for fromfile in fromfiles:
+                filesize = os.path.getsize(fromfile)
+                if not split_size or filesize <= split_size or fromfile[-3:].lower() != '.gz':
+                    continue
+                file_ranges[fromfile] = split_ranges(fromfile, -(-filesize // split_size), get_cdx_filename(fromfile))
+                if not silent:
+                    print('Split %s into %d parts' % (fromfile, len(file_ranges[fromfile])))
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+                futures = {}
+                for fromfile in fromfiles:
+                    if fromfile in file_ranges:
+                        futures[fromfile] = [executor.submit(index_warc_range, fromfile, tables, start, end, part, batch_size, self.dataset, fast_scan) for part, (start, end) in enumerate(file_ranges[fromfile])]
+                    else:
+                        futures[fromfile] = executor.submit(index_warc_file, fromfile, tables, True, batch_size, layout, self.dataset, checkpoint_size, fast_scan)
+                all_futures = []
+                for value in futures.values():
+                    all_futures.extend(value if isinstance(value, list) else [value])
+                done = as_completed(all_futures)
+                if not silent:
+                    done = tqdm.tqdm(done, desc='Index WARC files', total=len(all_futures))
+                for future in done:
+                    future.result()
+            for fromfile in fromfiles:
+                if fromfile not in file_ranges:
+                    results.append(futures[fromfile].result())
+                    continue
+                parts = [future.result() for future in futures[fromfile]]
+                table_filename = self.dataset.table_path(fromfile, 'records')
+                headers_filename = self.dataset.table_path(fromfile, 'headers')
+                records_writer = self.dataset.open_writer(fromfile, 'records', RECORDS_SCHEMA, batch_size=batch_size, layout=layout)
+                headers_writer = self.dataset.open_writer(fromfile, 'headers', HEADERS_SCHEMA, batch_size=batch_size, layout=layout)
+                num_records = merge_tables([part['records'] for part in parts if 'records' in part], records_writer, batch_size=batch_size)
+                num_headers = merge_tables([part['headers'] for part in parts if 'headers' in part], headers_writer, batch_size=batch_size)
+                results.append(self.file_result(fromfile, table_filename, num_records, headers_filename, num_headers))
+        else:
+            results.extend([self.index_file(fromfile, tables, rescan=True, silent=silent, batch_size=batch_size, layout=layout, checkpoint_size=checkpoint_size, fast_scan=fast_scan) for fromfile in fromfiles])
+
+        for result in results:
+            if result is None:
+                continue
+            file_record, file_tables = result
+            # fingerprint taken before indexing, file changed during indexing will be indexed again
+            file_record.update(fingerprints[file_record['filename']])
+            if not silent:
+                for table in file_tables:
+                    print('- saved %s with %s' % (table['path'], table['type']))
             list_files.append(file_record)
+            list_tables.extend(file_tables)
 
         if len(list_files) == 0:
             return
-        
-        pa_files = pa.Table.from_pylist(list_files)
-        if 'files' not in glob_tables:
-            con.sql("CREATE TABLE files (filename VARCHAR PRIMARY KEY,filesize BIGINT, num_records INTEGER);")
-            con.sql("INSERT OR REPLACE INTO files SELECT * FROM pa_files")
-        else:
-            con.sql("INSERT OR REPLACE INTO files SELECT * FROM pa_files")        
-        pa_tables = pa.Table.from_pylist(list_tables)
-        if 'tables' not in glob_tables:
-            con.sql("CREATE TABLE tables (warcfile VARCHAR, path VARCHAR PRIMARY KEY, type VARCHAR, num_items INTEGER);")
-            con.sql("INSERT OR REPLACE INTO tables SELECT * FROM pa_tables")
-        else:
-            con.sql("INSERT OR REPLACE INTO tables SELECT * FROM pa_tables")        
 
-       
-    def index_by_table_type(self, fromfiles:list=None, tofile:str='warcindex.db', table_type:str='links', rescan:bool=False, silent:bool=True):
+        con = duckdb.connect(tofile)
+        register_tables(con, list_files, list_tables)
+        update_lookup(con, list_tables)
+        update_stats(con, list_tables)
+
+    def index_by_table_type(self, fromfiles:list=None, tofile:str='warcindex.db', table_type:str='links', rescan:bool=False, silent:bool=True, workers:int=1, spill_size:int=DEFAULT_SPILL_SIZE, links_engine:str=DEFAULT_LINKS_ENGINE, cache_dir:str=None, cache_size:int=DEFAULT_CACHE_SIZE):
         """Generates parquet file with content type"""
+        self.index_content(fromfiles, tofile, table_types=[table_type], rescan=rescan, silent=silent, workers=workers, spill_size=spill_size, links_engine=links_engine, cache_dir=cache_dir, cache_size=cache_size)
+
+    def index_content(self, fromfiles:list=None, tofile:str='warcindex.db', table_types:list=['links'], rescan:bool=False, silent:bool=True, workers:int=1, spill_size:int=DEFAULT_SPILL_SIZE, links_engine:str=DEFAULT_LINKS_ENGINE, cache_dir:str=None, cache_size:int=DEFAULT_CACHE_SIZE):
+        """Generates parquet files for list of content types reading each WARC file once. With cache directory payloads cached by previous runs
+        not extracted again"""
+        # unknown engine raises ValueError before any WARC file read, not on each page
+        get_link_extractor(links_engine)
         con = duckdb.connect(tofile)
 
         list_tables = []
@@ -211,9 +607,12 @@ class Indexer:
         else:
             files = fromfiles
 
-        content_group = 'html' if table_type == 'links' else table_type
-        mimetypes = MIMES_EXT_TYPE_BY_GROUP[content_group]['mimes']
-        filetypes = MIMES_EXT_TYPE_BY_GROUP[content_group]['exts']
+        executor = None
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_extract_worker,
+                                           initargs=(cache_dir, cache_size))
+        reader = WarcRecordReader()
+        cache = ContentCache(cache_dir, cache_size) if cache_dir is not None else None
 
         for filename in files:
             rectables = con.sql(f"select * from tables where type = 'records' and warcfile = \'{filename}\';").df().to_dict('records')
@@ -223,77 +622,85 @@ class Indexer:
                 continue
             else:
                 recfilepath = rectables[0]['path']
-                if not os.path.exists(recfilepath):
+                if not table_exists(recfilepath):
                     if not silent:
                         print(f'Records file for {filename} not found')
                     continue
-            file_basename = os.path.basename(filename).lower()
-            if file_basename[-5:] == '.warc': 
-                file_basename - file_basename[0:-5]
-            elif file_basename[-8:] == '.warc.gz': 
-                file_basename = file_basename[0:-8]
-            
-            list_items = []
-
-            table_filename = 'data/' + file_basename + f'_{table_type}.parquet'
-            if os.path.exists(table_filename):
-                if not rescan:
-                    if not silent:
-                        print('Fole {table_filename} already exists and rescan option not set. Skipping')
-                        continue
-                else:
-                    if not silent:
-                        print('Fole {table_filename} already exists but rescan option set. Processing')
-
-            warcf = open(filename, "rb")  
-            content_types = ','.join(["'" + sub + "'" for sub in mimetypes])
-            query = f"select url, c_type, ext, \"offset\", warc_id from '{recfilepath}' where c_type IN ({content_types})"
-
-            records = con.sql(query).df().to_dict('records')
-            it = records if silent else tqdm.tqdm(records, desc=f'Processing {table_type} records from {filename}', total=len(records))
-            for item in it:
-                warcf.seek(int(item['offset']))
-                ait = iter(ArchiveIterator(warcf))
-                dbrec = next(ait)
-                if table_type == 'links':
-                    out_raw = BytesIO()
-                    buf = dbrec.content_stream().read(READ_SIZE)
-                    while buf:
-                        out_raw.write(buf)
-                        buf = dbrec.content_stream().read(READ_SIZE)
-                    try:
-                        only_a_tags = SoupStrainer("a")
-                        root = BeautifulSoup(out_raw.getvalue(), "lxml", parse_only=only_a_tags)
-                        if root is not None:
-                            for l in root:
-                                lrec = {'warc_id' : item['warc_id'], 'source' : filename, 'url' : item['url'], '_text' : l.text}
-                                for att in DEFAULT_LINK_ATTRS:
-                                    if att in l.attrs.keys(): 
-                                        lrec[att] = l.attrs[att]
-                                    else:
-                                        lrec[att] = None
-                                list_items.append(lrec)
-                    except KeyboardInterrupt:
-                        pass
-                    except ValueError:
-                        logging.info('Error parsing links from %s' % (item['url']))                    
-                        pass                    
-                else:                    
-                    list_items.append(processWarcRecord(dbrec, item['url'], filename, mime=item['c_type'], source=filename))
-
-            if len(list_items) > 0:
-                dump_table(filename=table_filename, table=list_items, con=con)
-                list_tables.append({'warcfile' : filename, 'path' :table_filename, 'type' : table_type, 'num_items' : len(list_items)})
+
+            table_filenames = {}
+            mime_types = {}
+            for table_type in table_types:
+                table_filename = self.dataset.table_path(filename, table_type)
+                if self.skip_file(table_filename, rescan=rescan, silent=silent):
+                    continue
+                table_filenames[table_type] = table_filename
+                content_group = 'html' if table_type == 'links' else table_type
+                for mime in MIMES_EXT_TYPE_BY_GROUP[content_group]['mimes']:
+                    mime_types.setdefault(mime, []).append(table_type)
+            if len(table_filenames) == 0:
+                continue
+
+            # All records of requested content types selected at once and read in order of their offsets
+            content_types = ','.join(["'" + sub + "'" for sub in mime_types.keys()])
+            # records file could be compacted and shared by several WARC files
+            prep_source = filename.replace("'", "''")
+            query = f"select url, c_type, ext, \"offset\", warc_id from {parquet_scan([recfilepath])} where source = '{prep_source}' and c_type IN ({content_types}) order by \"offset\""
+            if is_partitioned(recfilepath):
+                # only files of content type groups read
+                groups = ','.join(["'" + sub + "'" for sub in set([mime_group(mime) for mime in mime_types.keys()])])
+                query = f"select url, c_type, ext, \"offset\", warc_id from {parquet_scan([recfilepath], hive_partitioning=True)} where c_type_group IN ({groups}) and source = '{prep_source}' and c_type IN ({content_types}) order by \"offset\""
+            records = []
+            for record in con.sql(query).df().to_dict('records'):
+                for table_type in mime_types[record['c_type']]:
+                    records.append(dict(record, table_type=table_type))
+
+            list_items = {table_type : [] for table_type in table_filenames.keys()}
+            desc = f'Processing {",".join(table_filenames.keys())} records from {filename}'
+            if executor is not None:
+                # Records sent to worker processes in chunks, results returned in the same order as records
+                chunks = [records[i:i + EXTRACT_CHUNK_SIZE] for i in range(0, len(records), EXTRACT_CHUNK_SIZE)]
+                results = executor.map(extract_records, repeat(filename), chunks, repeat(spill_size), repeat(links_engine))
+                it = results if silent else tqdm.tqdm(results, desc=desc + ' in chunks', total=len(chunks))
+                for chunk, (chunk_results, hits, misses) in zip(chunks, it):
+                    for item, items in zip(chunk, chunk_results):
+                        list_items[item['table_type']].extend(items)
+                    if cache is not None:
+                        # counters of worker processes caches
+                        cache.hits += hits
+                        cache.misses += misses
+            else:
+                with reader.open(filename) as warcf:
+                    it = records if silent else tqdm.tqdm(records, desc=desc, total=len(records))
+                    for item in it:
+                        list_items[item['table_type']].extend(extract_record(warcf, item, filename, item['table_type'], spill_size, links_engine, cache))
                 if not silent:
-                    print(f'- saved {table_filename} with {table_type}')
+                    print(f'{filename}: {warcf.stats()}')
+
+            for table_type, table_filename in table_filenames.items():
+                if len(list_items[table_type]) > 0:
+                    self.dataset.prepare(filename, table_type)
+                    if table_type == 'links':
+                        # Links written with explicit schema, scheme, host and domain columns dictionary encoded
+                        with TableWriter(table_filename, LINKS_SCHEMA) as writer:
+                            writer.write_many(list_items[table_type])
+                    else:
+                        dump_table(filename=table_filename, table=list_items[table_type], con=con)
+                    list_tables.append({'warcfile' : filename, 'path' :table_filename, 'type' : table_type, 'num_items' : len(list_items[table_type])})
+                    if not silent:
+                        print(f'- saved {table_filename} with {table_type}')
+
+        if executor is not None:
+            executor.shutdown()
+        reader.close()
+        if cache is not None and not silent:
+            print(cache.stats().capitalize())
 
         if len(list_tables) == 0:
             return
 
         if not silent:
             print('Writing final tables metadata to db file')
-        pa_tables = pa.Table.from_pylist(list_tables)
-        con.sql("INSERT OR REPLACE INTO tables SELECT * FROM pa_tables")      
+        register_tables(con, [], list_tables)      
 
 
     def dump_metadata(self, fromfiles:list=None, tofile:str='warcindex.db', metadata_type:str='ooxmldocs', output:str=None, silent:bool=True):
@@ -315,15 +722,16 @@ class Indexer:
                 continue
             else:
                 mfilepath = mtables[0]['path']
+                prep_source = filename.replace("'", "''")
 
             if output is None:
-                query = f"select * from '{mfilepath}'"
+                query = f"select * from {parquet_scan([mfilepath])} where source = '{prep_source}'"
                 records = con.sql(query).df().to_dict('records')
                 for row in records:
                     print(json.dumps(row))
             else:
                 f = open(output, 'a', encoding='utf8')
-                query = f"select * from '{mfilepath}'"
+                query = f"select * from {parquet_scan([mfilepath])} where source = '{prep_source}'"
                 records = con.sql(query).df().to_dict('records')
                 for row in records:
                     f.write(json.dumps(row) + '\n')
@@ -332,35 +740,36 @@ class Indexer:
                     print(f'Writing final {metadata_type} for file {filename} metadata to {output}')
 
     def calc_stats(self, dbfile='warcindex.db', mode='mime'):
+        """Prints statistics merged from partial aggregates of WARC files"""
         from rich.table import Table
         from rich import print
         if not os.path.exists(dbfile):
             print(f'Plese generate {dbfile} database with "metawarc index <filename.warc> command"')
             return
-        con = duckdb.connect(dbfile)  
-       
-        if mode == 'mimes':
-             results = con.sql("select c_type, SUM(content_length), COUNT(warc_Id) from 'data/*_records.parquet' group by c_type ")
-             title = 'Group by mime type'
-             headers = ('mime', 'size', 'size share', 'count')
-        elif mode == 'exts':
-             results = con.sql("select ext, SUM(content_length), COUNT(warc_Id) from 'data/*_records.parquet' group by ext ")
-             title = 'Group by file extension'
-             headers = ('extension', 'size', 'size share', 'count')
-        else:
-            print('Plese select mode: mimes or exts')
-            return 
-  
+        modes = {'mimes' : ('Group by mime type', 'mime'), 'exts' : ('Group by file extension', 'extension'),
+                 'statuses' : ('Group by status code', 'status'), 'hosts' : ('Group by host', 'host'), 'dates' : ('Group by date', 'date')}
+        if mode not in modes.keys():
+            print('Plese select mode: %s' % (', '.join(modes.keys())))
+            return
+        con = duckdb.connect(dbfile)
+        refresh_stats(con)
+        order = 'key' if mode == 'dates' else 'SUM(size) DESC NULLS LAST'
+        rows = con.execute(f"select key, SUM(size), SUM(count) from stats where dimension = ? group by key order by {order}", [mode]).fetchall()
+        if len(rows) == 0:
+            print('No records tables found. Please reindex')
+            return
+        title, key_name = modes[mode]
+        headers = (key_name, 'size', 'size share', 'count')
+
         reptable = Table(title=title)
         reptable.add_column(headers[0], justify="left", style="magenta")
         for key in headers[1:-1]:
             reptable.add_column(key, justify="left", style="cyan", no_wrap=True)
         reptable.add_column(headers[-1], justify="right", style="cyan")
-        total_size = 0
-        for row in results.fetchall():
-            total_size += row[1]
-        for row in results.fetchall():
-            result = [row[0], row[1], '%0.2f%%' % (row[1] *100.0 / total_size), row[2]]
+        total_size = sum([row[1] for row in rows if row[1] is not None])
+        for row in rows:
+            share = '%0.2f%%' % (row[1] * 100.0 / total_size) if row[1] is not None and total_size > 0 else ''
+            result = [row[0], row[1], share, row[2]]
             reptable.add_row(*map(str, result))
         print(reptable)
 
@@ -0,0 +1,175 @@
+import logging
+from functools import lru_cache
+from urllib.parse import urljoin, urlsplit
+
+from lxml import etree
+import tldextract
+from bs4 import BeautifulSoup, SoupStrainer
+
+
+DEFAULT_LINK_ATTRS = ['href', 'class', 'id']
+
+# Attributes with space separated list of values, returned as lists same way as BeautifulSoup does
+MULTI_VALUED_ATTRS = ['class', 'rel', 'rev', 'accept-charset', 'headers', 'accesskey']
+
+DEFAULT_LINKS_ENGINE = 'lxml'
+
+# Columns added to each link after resolving it against page url
+RESOLVED_LINK_COLUMNS = ['abs_url', 'scheme', 'host', 'domain', 'is_internal']
+
+# Public suffix list snapshot bundled with tldextract used, so no network requests made while indexing
+_tld_extract = tldextract.TLDExtract(suffix_list_urls=())
+
+
+class SoupLinkExtractor:
+    """Extracts links by building BeautifulSoup tree of 'a' tags"""
+
+    name = 'bs4'
+
+    def __init__(self, attrs:list=DEFAULT_LINK_ATTRS):
+        self.attrs = attrs
+
+    def extract(self, content:bytes, encoding:str=None):
+        """Returns list of links as dicts with '_text' key and link attributes"""
+        links = []
+        only_a_tags = SoupStrainer("a")
+        root = BeautifulSoup(content, "lxml", parse_only=only_a_tags, from_encoding=encoding)
+        if root is not None:
+            for l in root:
+                lrec = {'_text' : l.text}
+                for att in self.attrs:
+                    if att in l.attrs.keys():
+                        lrec[att] = l.attrs[att]
+                    else:
+                        lrec[att] = None
+                links.append(lrec)
+        return links
+
+
+class LinksTarget:
+    """lxml parser target collecting 'a' tags attributes and text as parser emits events"""
+
+    def __init__(self, attrs:list):
+        self.attrs = attrs
+        self.links = []
+        self.current = None
+        self.text = []
+
+    def start(self, tag, attrib):
+        if tag != 'a':
+            return
+        if self.current is not None:
+            self.end('a')
+        lrec = {'_text' : None}
+        for att in self.attrs:
+            value = attrib.get(att)
+            if value is not None and att in MULTI_VALUED_ATTRS:
+                value = value.split()
+            lrec[att] = value
+        self.current = lrec
+        self.text = []
+
+    def end(self, tag):
+        if tag != 'a' or self.current is None:
+            return
+        self.current['_text'] = ''.join(self.text)
+        self.links.append(self.current)
+        self.current = None
+
+    def data(self, data):
+        if self.current is not None:
+            self.text.append(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        if self.current is not None:
+            self.end('a')
+        return self.links
+
+
+class LxmlLinkExtractor:
+    """Extracts links with lxml HTML parser in streaming mode, parser events handled by target without building a tree"""
+
+    name = 'lxml'
+
+    def __init__(self, attrs:list=DEFAULT_LINK_ATTRS):
+        self.attrs = attrs
+
+    def extract(self, content:bytes, encoding:str=None):
+        """Returns list of links as dicts with '_text' key and link attributes"""
+        if encoding is None:
+            try:
+                content.decode('utf8')
+                encoding = 'utf8'
+            except UnicodeDecodeError:
+                pass
+        try:
+            parser = etree.HTMLParser(target=LinksTarget(self.attrs), encoding=encoding)
+        except LookupError:
+            parser = etree.HTMLParser(target=LinksTarget(self.attrs))
+        parser.feed(content)
+        return parser.close()
+
+
+LINK_EXTRACTORS = {
+    'lxml' : LxmlLinkExtractor,
+    'bs4' : SoupLinkExtractor,
+}
+
+
+def get_link_extractor(engine:str=DEFAULT_LINKS_ENGINE, attrs:list=DEFAULT_LINK_ATTRS):
+    """Returns link extractor by engine name"""
+    if engine not in LINK_EXTRACTORS.keys():
+        raise ValueError('Unknown links engine %s. Possible values: %s' % (engine, ', '.join(LINK_EXTRACTORS.keys())))
+    return LINK_EXTRACTORS[engine](attrs)
+
+
+def extract_links(content:bytes, engine:str=DEFAULT_LINKS_ENGINE, encoding:str=None):
+    """Extracts links from HTML content, BeautifulSoup used if selected engine fails"""
+    extractor = get_link_extractor(engine)
+    try:
+        return extractor.extract(content, encoding=encoding)
+    except (etree.LxmlError, ValueError) as err:
+        if extractor.name == SoupLinkExtractor.name:
+            raise
+        logging.debug('Links engine %s failed: %s, using BeautifulSoup' % (extractor.name, str(err)))
+        return SoupLinkExtractor(extractor.attrs).extract(content, encoding=encoding)
+
+
+@lru_cache(maxsize=65536)
+def registered_domain(host:str):
+    """Returns registered domain of host like example.co.uk for www.example.co.uk by public suffix list"""
+    if not host:
+        return None
+    parts = _tld_extract(host)
+    if parts.domain and parts.suffix:
+        return parts.domain + '.' + parts.suffix
+    return host
+
+
+def resolve_links(page_url:str, links:list):
+    """Adds absolute url, scheme, host, registered domain and internal flag to links of single page"""
+    try:
+        page_domain = registered_domain(urlsplit(page_url).hostname)
+    except ValueError:
+        page_domain = None
+    for link in links:
+        href = link.get('href')
+        link.update(dict.fromkeys(RESOLVED_LINK_COLUMNS))
+        if href is None:
+            continue
+        try:
+            abs_url = urljoin(page_url, href.strip())
+            parts = urlsplit(abs_url)
+            host = parts.hostname
+        except ValueError:
+            continue
+        link['abs_url'] = abs_url
+        link['scheme'] = parts.scheme.lower() if parts.scheme else None
+        if host:
+            link['host'] = host
+            link['domain'] = registered_domain(host)
+            link['is_internal'] = link['domain'] == page_domain
+    return links
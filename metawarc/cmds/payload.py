@@ -0,0 +1,245 @@
+import io
+import os
+import zlib
+import logging
+from collections import OrderedDict
+
+from warcio.statusandheaders import StatusAndHeadersParser, StatusAndHeadersParserException
+
+from .reader import read_record
+
+
+HEAD_READ_SIZE = 65536
+MAX_HEAD_SIZE = 1024 * 1024
+RANGE_BLOCK_SIZE = 65536
+MEMBER_READ_SIZE = 16384
+COPY_BLOCK_SIZE = 1024 * 1024
+RANGE_CACHE_BLOCKS = 16
+
+WARC_VERSIONS = ['WARC/1.0', 'WARC/1.1', 'WARC/0.17', 'WARC/0.18']
+
+
+HTTP_RECORDS = ['response', 'request', 'revisit']
+HTTP_SCHEMES = ('http:', 'https:')
+
+
+def parse_record_head(read, offset:int):
+    """Parses WARC and HTTP headers of WARC record, read(size) returns up to size first bytes of uncompressed record.
+    HTTP headers parsed for the same records as warcio does. Returns dict with headers, offsets and lengths of block and payload
+    inside uncompressed record and total record length or None if record is not parseable"""
+    size = HEAD_READ_SIZE
+    while True:
+        data = read(size)
+        if data.find(b'\r\n\r\n') > -1:
+            break
+        if len(data) < size or size >= MAX_HEAD_SIZE:
+            return None
+        size *= 2
+    stream = io.BytesIO(data)
+    try:
+        rec_headers = StatusAndHeadersParser(WARC_VERSIONS, verify=False).parse(stream)
+    except (StatusAndHeadersParserException, EOFError) as err:
+        logging.info('Unable to parse WARC headers at offset %d: %s' % (offset, str(err)))
+        return None
+    warc_head_length = stream.tell()
+    try:
+        block_length = int(rec_headers.get_header('Content-Length', '0'))
+    except ValueError:
+        return None
+    uri = rec_headers.get_header('WARC-Target-URI', '')
+    if uri.startswith('<') and uri.endswith('>'):
+        uri = uri[1:-1]
+        rec_headers.replace_header('WARC-Target-URI', uri)
+    result = {'rec_headers' : rec_headers, 'http_headers' : None,
+              'block_offset' : offset + warc_head_length, 'block_length' : block_length,
+              'payload_offset' : offset + warc_head_length, 'payload_length' : block_length,
+              'length' : warc_head_length + block_length + 4}
+    rec_type = rec_headers.get_header('WARC-Type')
+    if rec_type in HTTP_RECORDS and uri.startswith(HTTP_SCHEMES) and block_length > 0:
+        block_end = warc_head_length + block_length
+        if data.find(b'\r\n\r\n', warc_head_length, block_end) == -1 and len(data) < min(block_end, MAX_HEAD_SIZE):
+            # HTTP headers not fit into head read size
+            data = read(min(block_end, MAX_HEAD_SIZE))
+        if data.find(b'\r\n\r\n', warc_head_length, block_end) == -1:
+            # revisit records could have no HTTP headers
+            return result if rec_type == 'revisit' else None
+        stream = io.BytesIO(data)
+        stream.seek(warc_head_length)
+        try:
+            http_headers = StatusAndHeadersParser([], verify=False).parse(stream)
+        except (StatusAndHeadersParserException, EOFError) as err:
+            logging.info('Unable to parse HTTP headers at offset %d: %s' % (offset, str(err)))
+            return None
+        http_head_length = stream.tell() - warc_head_length
+        result['http_headers'] = http_headers
+        result['payload_offset'] = offset + warc_head_length + http_head_length
+        result['payload_length'] = block_length - http_head_length
+    return result
+
+
+def read_record_head(fh, offset:int):
+    """Parses WARC and HTTP headers of uncompressed WARC record at offset without reading it's payload.
+    Returns dict with headers, payload offset and length and total record length or None if record is not parseable"""
+    fh.seek(offset)
+    if fh.read(2) == b'\x1f\x8b':
+        # gzip member, record could be only decompressed
+        return None
+
+    def read(size:int):
+        fh.seek(offset)
+        return fh.read(size)
+    return parse_record_head(read, offset)
+
+
+def read_member_head(fh, offset:int, length:int):
+    """Parses WARC and HTTP headers of gzipped WARC record at offset decompressing only beginning of it's gzip member.
+    Returns dict like read_record_head with offsets counted from start of uncompressed record and length of compressed record
+    or None if record is not parseable"""
+    decompressor = zlib.decompressobj(31)
+    state = {'data' : b'', 'pos' : offset}
+
+    def read(size:int):
+        while len(state['data']) < size and not decompressor.eof:
+            chunk = decompressor.unconsumed_tail
+            if not chunk:
+                if state['pos'] >= offset + length:
+                    break
+                fh.seek(state['pos'])
+                chunk = fh.read(min(MEMBER_READ_SIZE, offset + length - state['pos']))
+                if not chunk:
+                    break
+                state['pos'] += len(chunk)
+            state['data'] += decompressor.decompress(chunk, size - len(state['data']))
+        return state['data'][:size]
+
+    try:
+        head = parse_record_head(read, 0)
+    except zlib.error as err:
+        logging.info('Unable to decompress record at offset %d: %s' % (offset, str(err)))
+        return None
+    if head is not None:
+        head['length'] = length
+    return head
+
+
+def is_identity_encoded(http_headers):
+    """Checks that HTTP payload stored as is, without transfer or content encoding"""
+    if http_headers is None:
+        return True
+    for name in ['Transfer-Encoding', 'Content-Encoding']:
+        value = http_headers.get_header(name)
+        if value is not None and value.strip().lower() not in ['', 'identity']:
+            return False
+    return True
+
+
+class RangeReader(io.RawIOBase):
+    """Read-only seekable view of byte range of file. Only requested parts of range are read from disk,
+    recently read blocks are cached since parsers like pdfminer seek back and forth around the same places"""
+
+    def __init__(self, fh, start:int, length:int, block_size:int=RANGE_BLOCK_SIZE, cache_blocks:int=RANGE_CACHE_BLOCKS):
+        self.fh = fh
+        self.start = start
+        self.length = length
+        self.pos = 0
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.blocks = OrderedDict()
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos = self.pos + pos
+        elif whence == io.SEEK_END:
+            pos = self.length + pos
+        self.pos = max(0, min(pos, self.length))
+        return self.pos
+
+    def _block(self, num:int):
+        if num in self.blocks:
+            self.blocks.move_to_end(num)
+            return self.blocks[num]
+        self.fh.seek(self.start + num * self.block_size)
+        block = self.fh.read(min(self.block_size, self.length - num * self.block_size))
+        self.bytes_read += len(block)
+        self.blocks[num] = block
+        if len(self.blocks) > self.cache_blocks:
+            self.blocks.popitem(last=False)
+        return block
+
+    def readinto(self, buf):
+        size = min(len(buf), self.length - self.pos)
+        written = 0
+        while written < size:
+            num, shift = divmod(self.pos, self.block_size)
+            block = self._block(num)
+            chunk = block[shift:shift + size - written]
+            if not chunk:
+                break
+            buf[written:written + len(chunk)] = chunk
+            written += len(chunk)
+            self.pos += len(chunk)
+        return written
+
+
+def open_payload(fh, offset:int):
+    """Opens lazy seekable reader of payload of uncompressed WARC record at offset.
+    Returns tuple of reader and payload length or None if payload can't be read as byte range"""
+    head = read_record_head(fh, offset)
+    if head is None or not is_identity_encoded(head['http_headers']):
+        return None
+    reader = RangeReader(fh, head['payload_offset'], head['payload_length'])
+    return reader, head['payload_length']
+
+
+def payload_range(fh, offset:int):
+    """Returns offset and length of payload of uncompressed WARC record at offset if payload stored as is,
+    None for gzipped records and encoded payloads"""
+    head = read_record_head(fh, offset)
+    if head is None or not is_identity_encoded(head['http_headers']):
+        return None
+    return head['payload_offset'], head['payload_length']
+
+
+def payload_stream(fh, offset:int):
+    """Returns stream of decoded payload of WARC record at offset. Payload of uncompressed record stored as is read as byte range"""
+    byte_range = payload_range(fh, offset)
+    if byte_range is not None:
+        return RangeReader(fh, byte_range[0], byte_range[1])
+    return read_record(fh, offset).content_stream()
+
+
+def copy_range(fh, out, offset:int, length:int):
+    """Copies byte range of file to output file with os.sendfile, so data not copied through Python.
+    Falls back to read and write loop where sendfile not supported. Returns number of bytes copied"""
+    copied = 0
+    if hasattr(os, 'sendfile'):
+        out.flush()
+        try:
+            while copied < length:
+                sent = os.sendfile(out.fileno(), fh.fileno(), offset + copied, length - copied)
+                if sent == 0:
+                    break
+                copied += sent
+            return copied
+        except OSError as err:
+            if copied > 0:
+                raise
+            logging.debug('sendfile not supported, copying by blocks: %s' % str(err))
+    fh.seek(offset)
+    while copied < length:
+        buf = fh.read(min(COPY_BLOCK_SIZE, length - copied))
+        if not buf:
+            break
+        out.write(buf)
+        copied += len(buf)
+    return copied
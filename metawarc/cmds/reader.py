@@ -0,0 +1,236 @@
+import io
+import os
+import mmap
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from warcio import ArchiveIterator
+
+
+DEFAULT_READAHEAD_SIZE = 4 * 1024 * 1024
+DEFAULT_POOL_SIZE = 64
+
+
+class ReadAheadFile:
+    """Read-only file wrapper reading file by large sequential blocks. Records selected in order of their offsets
+    mostly served from the same block, so nearby records combined into one read instead of seek and read for each.
+    Counts bytes read from disk and bytes skipped between read blocks"""
+
+    def __init__(self, fh, buffer_size:int=DEFAULT_READAHEAD_SIZE):
+        self.fh = fh
+        self.buffer_size = buffer_size
+        self.buf = b''
+        self.buf_start = 0
+        self.pos = 0
+        self.last_end = 0
+        self.bytes_read = 0
+        self.bytes_skipped = 0
+        self.reads = 0
+        self.name = getattr(fh, 'name', None)
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos = self.pos + pos
+        elif whence == io.SEEK_END:
+            pos = os.fstat(self.fh.fileno()).st_size + pos
+        self.pos = max(0, pos)
+        return self.pos
+
+    def _fill(self, size:int):
+        """Reads new block starting at current position"""
+        if self.pos >= self.last_end:
+            self.bytes_skipped += self.pos - self.last_end
+        self.fh.seek(self.pos)
+        buf = self.fh.read(max(size, self.buffer_size))
+        if not buf:
+            # end of file, current block kept
+            return False
+        self.reads += 1
+        self.buf = buf
+        self.buf_start = self.pos
+        self.last_end = self.pos + len(buf)
+        self.bytes_read += len(buf)
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(self.buffer_size)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks)
+        shift = self.pos - self.buf_start
+        if shift < 0 or shift >= len(self.buf):
+            if not self._fill(size):
+                return b''
+            shift = 0
+        data = self.buf[shift:shift + size]
+        if len(data) < size and len(data) > 0:
+            # rest of requested data is in the next block
+            self.pos += len(data)
+            rest = self.read(size - len(data))
+            return data + rest
+        self.pos += len(data)
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.buf = b''
+        self.fh.close()
+
+    def stats(self):
+        """Returns human readable read statistics"""
+        return 'read %0.2f MB in %d reads, skipped %0.2f MB' % (self.bytes_read / 1048576.0, self.reads, self.bytes_skipped / 1048576.0)
+
+
+def read_record(fileobj, offset:int):
+    """Returns warcio record at offset of WARC file object"""
+    fileobj.seek(offset)
+    return next(iter(ArchiveIterator(fileobj)))
+
+
+class MappedFile(io.RawIOBase):
+    """Read-only file object over memory mapped WARC file with it's own position, so several threads read the same mapping.
+    Like ReadAheadFile counts bytes of file touched by reads, number of separate ranges read and bytes skipped between them,
+    bytes read again inside already touched range not counted. File descriptor kept for sendfile"""
+
+    def __init__(self, mapping, fh, name:str=None):
+        self.mapping = mapping
+        self.fh = fh
+        self.name = name
+        self.size = len(mapping)
+        self.pos = 0
+        self.range_start = 0
+        self.last_end = 0
+        self.bytes_read = 0
+        self.bytes_skipped = 0
+        self.reads = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos = self.pos + pos
+        elif whence == io.SEEK_END:
+            pos = self.size + pos
+        self.pos = max(0, pos)
+        return self.pos
+
+    def touch(self, start:int, length:int):
+        """Counts byte range read from mapping or copied from file descriptor"""
+        end = start + length
+        if length <= 0 or (start >= self.range_start and end <= self.last_end):
+            return
+        if self.reads == 0 or start > self.last_end or start < self.range_start:
+            # new range started
+            self.reads += 1
+            if start > self.last_end:
+                self.bytes_skipped += start - self.last_end
+            self.range_start = start
+            self.bytes_read += length
+        else:
+            self.bytes_read += end - self.last_end
+        self.last_end = max(end, self.last_end)
+
+    def readinto(self, buf):
+        data = self.mapping[self.pos:self.pos + len(buf)]
+        buf[:len(data)] = data
+        self.touch(self.pos, len(data))
+        self.pos += len(data)
+        return len(data)
+
+    def stats(self):
+        """Returns human readable read statistics"""
+        return 'read %0.2f MB in %d ranges, skipped %0.2f MB' % (self.bytes_read / 1048576.0, self.reads, self.bytes_skipped / 1048576.0)
+
+
+class WarcRecordReader:
+    """Shared access to records of WARC files by offset. WARC files mapped to memory once and kept in LRU pool of limited size,
+    files in use are not closed. Safe to use from several threads, each open call returns file object with it's own position"""
+
+    def __init__(self, pool_size:int=DEFAULT_POOL_SIZE):
+        self.pool_size = pool_size
+        self.pool = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _acquire(self, source:str):
+        with self.lock:
+            entry = self.pool.get(source)
+            if entry is None:
+                fh = open(source, 'rb')
+                try:
+                    mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # empty file could not be mapped
+                    mapping = b''
+                entry = {'fh' : fh, 'mapping' : mapping, 'users' : 0}
+                self.pool[source] = entry
+            self.pool.move_to_end(source)
+            entry['users'] += 1
+            self._evict()
+        return entry
+
+    def _release(self, source:str):
+        with self.lock:
+            self.pool[source]['users'] -= 1
+            self._evict()
+
+    def _evict(self):
+        """Closes least recently used files not in use while pool is larger than it's size"""
+        for source in list(self.pool.keys()):
+            if len(self.pool) <= self.pool_size:
+                break
+            if self.pool[source]['users'] == 0:
+                self._close_entry(self.pool.pop(source))
+
+    def _close_entry(self, entry:dict):
+        if isinstance(entry['mapping'], mmap.mmap):
+            entry['mapping'].close()
+        entry['fh'].close()
+
+    @contextmanager
+    def open(self, source:str):
+        """Returns file object reading WARC file from shared mapping"""
+        entry = self._acquire(source)
+        try:
+            yield MappedFile(entry['mapping'], entry['fh'], name=source)
+        finally:
+            self._release(source)
+
+    def close(self):
+        with self.lock:
+            for entry in self.pool.values():
+                self._close_entry(entry)
+            self.pool.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
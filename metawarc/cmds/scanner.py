@@ -0,0 +1,230 @@
+import os
+import json
+import logging
+import zlib
+from bisect import bisect_left, bisect_right
+
+from .payload import read_record_head, read_member_head
+from .reader import ReadAheadFile
+
+
+GZIP_MAGIC = b'\x1f\x8b\x08'
+SCAN_BLOCK_SIZE = 1024 * 1024
+CHECK_SIZE = 16384
+
+# Records of uncompressed WARC files are small or skipped, so short read ahead used by head scanner
+SCAN_READAHEAD_SIZE = 256 * 1024
+
+# Default CDX 11 fields used by most tools if CDX file has no header
+DEFAULT_CDX_FIELDS = ['N', 'b', 'a', 'm', 's', 'k', 'r', 'M', 'S', 'V', 'g']
+
+
+def cdx_fields(line:str):
+    """Returns list of CDX field letters from CDX header line like ' CDX N b a m s k r M S V g'"""
+    parts = line.split()
+    if len(parts) > 1 and parts[0] == 'CDX':
+        return parts[1:]
+    return None
+
+
+def cdx_records(cdx_filename:str):
+    """Iterates WARC record offsets and compressed lengths from CDX or CDXJ file. Length is None if not set"""
+    with open(cdx_filename, 'r', encoding='utf8', errors='ignore') as f:
+        fields = None
+        for line in f:
+            if fields is None:
+                fields = cdx_fields(line)
+                if fields is not None:
+                    continue
+                fields = DEFAULT_CDX_FIELDS
+            line = line.rstrip('\n')
+            if len(line) == 0:
+                continue
+            pos = line.find(' {')
+            if pos > -1:
+                # CDXJ line: surt timestamp {json}
+                try:
+                    data = json.loads(line[pos + 1:])
+                except ValueError:
+                    continue
+                if 'offset' in data.keys():
+                    length = data.get('length')
+                    yield int(data['offset']), int(length) if length is not None else None
+                continue
+            parts = line.split(' ')
+            if 'V' in fields and len(parts) == len(fields):
+                value = parts[fields.index('V')]
+                if value.isdigit():
+                    length = parts[fields.index('S')] if 'S' in fields else None
+                    yield int(value), int(length) if length is not None and length.isdigit() else None
+
+
+def cdx_offsets(cdx_filename:str):
+    """Iterates WARC record offsets from CDX or CDXJ file"""
+    for offset, length in cdx_records(cdx_filename):
+        yield offset
+
+
+def cdx_layout(cdx_filename:str):
+    """Returns CDX field letters, number of header lines and CDXJ flag of CDX file"""
+    with open(cdx_filename, 'r', encoding='utf8', errors='ignore') as f:
+        line = f.readline()
+    fields = cdx_fields(line)
+    if fields is not None:
+        return fields, 1, False
+    return DEFAULT_CDX_FIELDS, 0, line.find(' {') > -1
+
+
+def cdx_records_sql(cdx_filename:str, source:str):
+    """Returns DuckDB query selecting columns of records table from CDX or CDXJ file ordered by offset.
+    Only records with HTTP status selected same way as response records with HTTP headers, revisit records skipped.
+    WARC record id and content length not stored in CDX, they are null"""
+    fields, skip, is_cdxj = cdx_layout(cdx_filename)
+    prep_name = cdx_filename.replace("'", "''")
+    prep_source = source.replace("'", "''")
+    lines = f"read_csv('{prep_name}', columns={{'line' : 'VARCHAR'}}, header=false, delim='\x01', quote='', escape='', skip={skip}, auto_detect=false)"
+    if is_cdxj:
+        entries = f"""SELECT json_extract_string(j, '$.url') AS url, json_extract_string(j, '$.mime') AS mime, json_extract_string(j, '$.status') AS status,
+            json_extract_string(j, '$.offset') AS "offset", json_extract_string(j, '$.length') AS length, split_part(line, ' ', 2) AS ts
+            FROM (SELECT line, substr(line, strpos(line, ' {{') + 1) AS j FROM {lines} WHERE strpos(line, ' {{') > 0)"""
+    else:
+        def field(letter:str):
+            return f"p[{fields.index(letter) + 1}]" if letter in fields else 'NULL'
+        entries = f"""SELECT {field('a')} AS url, {field('m')} AS mime, {field('s')} AS status, {field('V')} AS "offset", {field('S')} AS length, {field('b')} AS ts
+            FROM (SELECT string_split(line, ' ') AS p FROM {lines}) WHERE len(p) = {len(fields)}"""
+    # content type, charset, file name and extension calculated same way as while reading WARC file
+    return f"""SELECT NULL::VARCHAR AS warc_id, url, mime AS content_type,
+        CASE WHEN contains(mime, ';') THEN lower(trim(split_part(mime, ';', 1))) ELSE mime END AS c_type,
+        CASE WHEN contains(mime, ';') THEN (CASE WHEN contains(charset, '=') THEN lower(trim(substr(charset, strpos(charset, '=') + 1))) ELSE charset END) END AS c_type_charset,
+        "offset"::BIGINT AS "offset", try_cast(length AS BIGINT) AS length, timezone('UTC', try_strptime(rpad(ts, 14, '0'), '%Y%m%d%H%M%S')) AS rec_date,
+        NULL::BIGINT AS content_length, status::BIGINT AS status_code, '{prep_source}' AS source, filename,
+        CASE WHEN contains(filename, '.') THEN regexp_extract(filename, '[^.]*$') ELSE '' END AS ext
+        FROM (SELECT *, substr(mime, strpos(mime, ';') + 1) AS charset, lower(regexp_extract(regexp_replace(url, '\\?[^?]*$', ''), '[^/]*$')) AS filename
+              FROM (SELECT url, nullif(mime, '-') AS mime, status, "offset", length, ts FROM ({entries})))
+        WHERE regexp_full_match(status, '[0-9]+') AND regexp_full_match("offset", '[0-9]+') AND coalesce(mime, '') <> 'warc/revisit'
+        ORDER BY "offset" """
+
+
+def is_member_start(fh, offset:int):
+    """Checks that gzip member starting at offset decompresses to WARC record"""
+    fh.seek(offset)
+    data = fh.read(CHECK_SIZE)
+    if not data.startswith(GZIP_MAGIC):
+        return False
+    try:
+        head = zlib.decompressobj(31).decompress(data, 8)
+    except zlib.error:
+        return False
+    return head.startswith(b'WARC/')
+
+
+def find_member_start(fh, position:int, limit:int):
+    """Finds first gzip member starting WARC record at or after position and before limit. Returns limit if not found"""
+    while position < limit:
+        fh.seek(position)
+        block = fh.read(min(SCAN_BLOCK_SIZE, limit - position) + len(GZIP_MAGIC) - 1)
+        if not block:
+            break
+        pos = block.find(GZIP_MAGIC)
+        while pos > -1:
+            if position + pos >= limit:
+                return limit
+            if is_member_start(fh, position + pos):
+                return position + pos
+            pos = block.find(GZIP_MAGIC, pos + 1)
+        position += SCAN_BLOCK_SIZE
+    return limit
+
+
+def split_ranges(filename:str, parts:int, cdx_filename:str=None):
+    """Splits gzipped WARC file into byte ranges at gzip member boundaries. Member offsets taken from CDX file
+    if it's provided, otherwise found by scanning file near split points. Returns list of (start, end) tuples"""
+    filesize = os.path.getsize(filename)
+    if parts < 2 or filesize == 0:
+        return [(0, filesize)]
+    targets = [filesize * i // parts for i in range(1, parts)]
+    bounds = [None] * len(targets)
+    with open(filename, 'rb') as fh:
+        if cdx_filename is not None and os.path.exists(cdx_filename):
+            # closest record offset after each split point
+            for offset in cdx_offsets(cdx_filename):
+                i = bisect_right(targets, offset) - 1
+                if i >= 0 and (bounds[i] is None or offset < bounds[i]):
+                    bounds[i] = offset
+            for i in range(len(bounds)):
+                if bounds[i] is not None and not is_member_start(fh, bounds[i]):
+                    logging.info('CDX offset %d is not a WARC record start in %s' % (bounds[i], filename))
+                    bounds[i] = None
+        for i in range(len(bounds)):
+            if bounds[i] is None:
+                bounds[i] = find_member_start(fh, targets[i], filesize)
+    starts = sorted(set([0] + [b for b in bounds if b < filesize]))
+    ends = starts[1:] + [filesize]
+    return list(zip(starts, ends))
+
+
+class HeadScanner:
+    """Iterates WARC and HTTP headers of records from start offset to end offset without reading payloads.
+    Records of uncompressed WARC file skipped by their Content-Length. Gzipped records decompressed only till end of headers,
+    their offsets and lengths taken from CDX file. Iteration stops at first record which could not be parsed,
+    it's offset saved as failed_offset. Offset of first record after end offset saved as next_offset"""
+
+    def __init__(self, fh, filesize:int, start:int=0, end:int=None, members:list=None):
+        self.fh = fh
+        self.filesize = filesize
+        self.start = start
+        self.end = end
+        self.members = members
+        self.next_offset = None
+        self.failed_offset = None
+
+    def __iter__(self):
+        """Yields offset, length and parsed head of each record"""
+        if self.members is None:
+            return self._scan_plain()
+        return self._scan_members()
+
+    def _scan_plain(self):
+        fh = ReadAheadFile(self.fh, buffer_size=SCAN_READAHEAD_SIZE)
+        offset = self.start
+        while offset < self.filesize:
+            if self.end is not None and offset >= self.end:
+                self.next_offset = offset
+                return
+            head = read_record_head(fh, offset)
+            if head is None:
+                self.failed_offset = offset
+                return
+            # record length without trailing CRLFs same as warcio returns
+            yield offset, head['block_offset'] + head['block_length'] - offset, head
+            offset += head['length']
+
+    def _scan_members(self):
+        offsets = [offset for offset, length in self.members]
+        for i in range(bisect_left(offsets, self.start), len(self.members)):
+            offset, length = self.members[i]
+            if self.end is not None and offset >= self.end:
+                self.next_offset = offset
+                return
+            if length is None:
+                length = (offsets[i + 1] if i + 1 < len(offsets) else self.filesize) - offset
+            head = read_member_head(self.fh, offset, length)
+            if head is None:
+                logging.info('Unable to read headers of gzipped record at offset %d' % (offset))
+                self.failed_offset = offset
+                return
+            yield offset, length, head
+
+
+def open_head_scanner(fh, filename:str, start:int=0, end:int=None, cdx_filename:str=None):
+    """Returns scanner of record headers of WARC file or None if file is gzipped and has no CDX file"""
+    filesize = os.path.getsize(filename)
+    fh.seek(start)
+    if not fh.read(len(GZIP_MAGIC)) == GZIP_MAGIC:
+        return HeadScanner(fh, filesize, start, end)
+    if cdx_filename is None or not os.path.exists(cdx_filename):
+        return None
+    members = sorted(dict(cdx_records(cdx_filename)).items())
+    if len(members) == 0:
+        return None
+    return HeadScanner(fh, filesize, start, end, members)
@@ -0,0 +1,166 @@
+import os
+import time
+import zlib
+import tarfile
+import zipfile
+import tempfile
+import threading
+
+from warcio.utils import BUFF_SIZE
+
+
+READ_SIZE = BUFF_SIZE * 4
+
+SHARD_FORMATS = ['tar', 'zip', 'warc']
+DEFAULT_SHARD_SIZE = 1024 * 1024 * 1024
+
+# Payloads up to this size kept in memory while tar member size is not known
+SPOOL_SIZE = 16 * 1024 * 1024
+
+# Columns added to records.csv with location of payload or record in shard
+SHARD_COLUMNS = ['shard', 'shard_offset', 'shard_length']
+
+
+def copy_stream(stream, dest):
+    """Copies stream to file object. Returns number of bytes copied"""
+    written = 0
+    buf = stream.read(READ_SIZE)
+    while buf:
+        dest.write(buf)
+        written += len(buf)
+        buf = stream.read(READ_SIZE)
+    return written
+
+
+class TarShard:
+    """Tar file with payloads as members"""
+
+    ext = 'tar'
+
+    def __init__(self, filename:str):
+        self.filename = filename
+        self.tar = tarfile.open(filename, 'w', format=tarfile.PAX_FORMAT)
+
+    def size(self):
+        return self.tar.offset
+
+    def add_payload(self, name:str, stream):
+        """Adds payload as tar member. Returns offset and length of member data"""
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as tmp:
+            written = copy_stream(stream, tmp)
+            tmp.seek(0)
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = written
+            tarinfo.mtime = int(time.time())
+            self.tar.addfile(tarinfo, tmp)
+        # member data padded to block size
+        padded = -(-written // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        return self.tar.offset - padded, written
+
+    def close(self):
+        self.tar.close()
+
+
+class ZipShard:
+    """Zip file with payloads stored without compression, so each payload could be read by offset"""
+
+    ext = 'zip'
+
+    def __init__(self, filename:str):
+        self.filename = filename
+        self.zip = zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        self.offset = 0
+
+    def size(self):
+        return self.offset
+
+    def add_payload(self, name:str, stream):
+        """Adds payload as zip member. Returns offset and length of member data"""
+        with self.zip.open(name, 'w', force_zip64=True) as dest:
+            data_offset = self.zip.fp.tell()
+            written = copy_stream(stream, dest)
+        self.offset = data_offset + written
+        return data_offset, written
+
+    def close(self):
+        self.zip.close()
+
+
+class WarcShard:
+    """Gzipped WARC file with original records. Gzipped records copied as is, uncompressed records compressed as gzip members"""
+
+    ext = 'warc.gz'
+
+    def __init__(self, filename:str):
+        self.filename = filename
+        self.fh = open(filename, 'wb')
+
+    def size(self):
+        return self.fh.tell()
+
+    def add_record(self, fileobj, offset:int, length:int):
+        """Copies WARC record from file object. Returns offset and length of record in shard"""
+        start = self.fh.tell()
+        fileobj.seek(offset)
+        compressor = None if fileobj.read(2) == b'\x1f\x8b' else zlib.compressobj(wbits=31)
+        fileobj.seek(offset)
+        left = length
+        while left > 0:
+            buf = fileobj.read(min(READ_SIZE, left))
+            if not buf:
+                break
+            left -= len(buf)
+            self.fh.write(buf if compressor is None else compressor.compress(buf))
+        if compressor is not None:
+            # record length of uncompressed WARC file not includes records separator
+            self.fh.write(compressor.compress(b'\r\n\r\n'))
+            self.fh.write(compressor.flush())
+        return start, self.fh.tell() - start
+
+    def close(self):
+        self.fh.close()
+
+
+SHARD_CLASSES = {'tar' : TarShard, 'zip' : ZipShard, 'warc' : WarcShard}
+
+
+class ShardSet:
+    """Shards written by dump threads. Each thread writes it's own sequence of shards named shard-<thread>-<number>,
+    next shard started when current one reaches shard size"""
+
+    def __init__(self, output:str, shard_format:str='tar', shard_size:int=DEFAULT_SHARD_SIZE):
+        if shard_format not in SHARD_CLASSES.keys():
+            raise ValueError('Unknown shard format %s. Possible values: %s' % (shard_format, ', '.join(SHARD_CLASSES.keys())))
+        self.output = output
+        self.shard_format = shard_format
+        self.shard_size = shard_size
+        self.lock = threading.Lock()
+        self.writers = {}
+        self.filenames = []
+
+    def current(self):
+        """Returns shard of current thread with free space"""
+        key = threading.get_ident()
+        with self.lock:
+            if key not in self.writers.keys():
+                self.writers[key] = {'num' : len(self.writers), 'seq' : 0, 'shard' : None}
+            state = self.writers[key]
+        shard = state['shard']
+        if shard is not None and shard.size() >= self.shard_size:
+            shard.close()
+            shard = None
+        if shard is None:
+            shard_class = SHARD_CLASSES[self.shard_format]
+            filename = os.path.join(self.output, 'shard-%02d-%05d.%s' % (state['num'], state['seq'], shard_class.ext))
+            shard = shard_class(filename)
+            with self.lock:
+                self.filenames.append(filename)
+            state['seq'] += 1
+            state['shard'] = shard
+        return shard
+
+    def close(self):
+        for state in self.writers.values():
+            if state['shard'] is not None:
+                state['shard'].close()
+                state['shard'] = None
@@ -0,0 +1,213 @@
+import os
+import logging
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+DEFAULT_BATCH_SIZE = 50000
+DEFAULT_COMPRESSION_LEVEL = 3
+
+RECORDS_SCHEMA = pa.schema([
+    ('warc_id', pa.string()),
+    ('url', pa.string()),
+    ('content_type', pa.string()),
+    ('c_type', pa.string()),
+    ('c_type_charset', pa.string()),
+    ('offset', pa.int64()),
+    ('length', pa.int64()),
+    ('rec_date', pa.timestamp('us', tz='UTC')),
+    ('content_length', pa.int64()),
+    ('status_code', pa.int64()),
+    ('source', pa.string()),
+    ('filename', pa.string()),
+    ('ext', pa.string()),
+])
+
+HEADERS_SCHEMA = pa.schema([
+    ('key', pa.string()),
+    ('value', pa.string()),
+    ('warc_id', pa.string()),
+    ('source', pa.string()),
+])
+
+LINKS_SCHEMA = pa.schema([
+    ('warc_id', pa.string()),
+    ('source', pa.string()),
+    ('url', pa.string()),
+    ('_text', pa.string()),
+    ('href', pa.string()),
+    ('class', pa.list_(pa.string())),
+    ('id', pa.string()),
+    ('abs_url', pa.string()),
+    ('scheme', pa.dictionary(pa.int32(), pa.string())),
+    ('host', pa.dictionary(pa.int32(), pa.string())),
+    ('domain', pa.dictionary(pa.int32(), pa.string())),
+    ('is_internal', pa.bool_()),
+])
+
+
+class TableLayout:
+    """Parquet file layout options: sort order, row group size, compression level, bloom filters and column encodings.
+    Options referring columns missing in table schema are ignored"""
+
+    def __init__(self, sort_by:list=None, row_group_size:int=None, compression_level:int=DEFAULT_COMPRESSION_LEVEL, bloom_filters:list=None, encodings:dict=None):
+        self.sort_by = sort_by if sort_by else []
+        self.row_group_size = row_group_size
+        self.compression_level = compression_level
+        self.bloom_filters = bloom_filters if bloom_filters else []
+        self.encodings = encodings if encodings else {}
+
+    def sort_columns(self, schema:pa.Schema):
+        """Returns sort columns if all of them exist in schema, otherwise empty list"""
+        if all(name in schema.names for name in self.sort_by):
+            return self.sort_by
+        return []
+
+    def writer_options(self, schema:pa.Schema, row_group_size:int):
+        """Returns parquet writer keyword arguments for table schema"""
+        options = {'compression' : 'zstd', 'compression_level' : self.compression_level}
+        bloom_filters = [name for name in self.bloom_filters if name in schema.names]
+        if len(bloom_filters) > 0:
+            # one filter per row group, sized by number of rows
+            options['bloom_filter_options'] = {name : {'ndv' : row_group_size} for name in bloom_filters}
+        encodings = {name : encoding for name, encoding in self.encodings.items() if name in schema.names}
+        if len(encodings) > 0:
+            # columns with explicit encoding couldn't be dictionary encoded
+            options['use_dictionary'] = [name for name in schema.names if name not in encodings.keys()]
+            options['column_encoding'] = encodings
+        return options
+
+
+def parse_encodings(value:str):
+    """Parses comma separated list of column:ENCODING pairs into dict"""
+    encodings = {}
+    if not value:
+        return encodings
+    for pair in value.split(','):
+        if pair.find(':') == -1:
+            raise ValueError('Column encoding should be set as column:ENCODING, got %s' % pair)
+        name, encoding = pair.split(':', 1)
+        encodings[name.strip()] = encoding.strip().upper()
+    return encodings
+
+
+class TableWriter:
+    """Writes rows to parquet file as fixed size record batches, each batch written as separate row group.
+    File written under temporary name and renamed on close, no file created if no rows written.
+    If layout has sort columns, file rewritten sorted on close"""
+
+    def __init__(self, filename:str, schema:pa.Schema, batch_size:int=DEFAULT_BATCH_SIZE, layout:TableLayout=None):
+        self.filename = filename
+        self.schema = schema
+        self.layout = layout if layout is not None else TableLayout()
+        self.batch_size = self.layout.row_group_size if self.layout.row_group_size else batch_size
+        self.sort_by = self.layout.sort_columns(schema)
+        self.tempname = filename + '.tmp'
+        self.writer = None
+        self.rows = []
+        self.num_rows = 0
+
+    def _open(self):
+        if self.writer is None:
+            if self.sort_by:
+                # unsorted data is temporary, written fast
+                options = {'compression' : 'zstd', 'compression_level' : 1}
+            else:
+                options = self.layout.writer_options(self.schema, self.batch_size)
+            self.writer = pq.ParquetWriter(self.tempname, self.schema, **options)
+
+    def write(self, row:dict):
+        """Adds row, flushes batch to disk if batch size reached"""
+        self.rows.append(row)
+        self.num_rows += 1
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, rows:list):
+        """Adds list of rows"""
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        """Writes buffered rows as record batch"""
+        if len(self.rows) == 0:
+            return
+        self._open()
+        batch = pa.RecordBatch.from_pylist(self.rows, schema=self.schema)
+        self.writer.write_batch(batch, row_group_size=self.batch_size)
+        self.rows = []
+
+    def write_batch(self, batch:pa.RecordBatch):
+        """Writes already prepared record batch"""
+        self.flush()
+        if batch.num_rows == 0:
+            return
+        self._open()
+        self.writer.write_batch(batch, row_group_size=self.batch_size)
+        self.num_rows += batch.num_rows
+
+    def sort(self):
+        """Rewrites temporary file ordered by sort columns. DuckDB sort spills to disk if data not fit memory"""
+        sortedname = self.filename + '.sorted.tmp'
+        order = ','.join(['"' + name + '"' for name in self.sort_by])
+        source = self.tempname.replace("'", "''")
+        con = duckdb.connect()
+        reader = con.sql(f"SELECT * FROM read_parquet('{source}') ORDER BY {order}").to_arrow_reader(self.batch_size)
+        writer = pq.ParquetWriter(sortedname, self.schema, **self.layout.writer_options(self.schema, self.batch_size))
+        try:
+            for batch in reader:
+                writer.write_table(pa.Table.from_batches([batch]).cast(self.schema), row_group_size=self.batch_size)
+        finally:
+            writer.close()
+            con.close()
+        os.replace(sortedname, self.tempname)
+
+    def close(self):
+        """Flushes remaining rows and moves file to it's final name. Returns number of rows written"""
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            if self.sort_by:
+                self.sort()
+            os.replace(self.tempname, self.filename)
+        return self.num_rows
+
+    def abort(self):
+        """Closes writer and removes unfinished file"""
+        self.rows = []
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if os.path.exists(self.tempname):
+            os.remove(self.tempname)
+            logging.debug('Removed unfinished file %s' % self.tempname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def merge_tables(parts:list, writer:TableWriter, batch_size:int=DEFAULT_BATCH_SIZE, keep:bool=False):
+    """Merges parquet files into writer keeping their order and removes merged files unless keep set. Returns number of rows"""
+    with writer:
+        for part in parts:
+            if not os.path.exists(part):
+                continue
+            pf = pq.ParquetFile(part)
+            for batch in pf.iter_batches(batch_size=batch_size):
+                writer.write_batch(batch)
+            pf.close()
+    if keep:
+        return writer.num_rows
+    for part in parts:
+        if os.path.exists(part):
+            os.remove(part)
+    return writer.num_rows
@@ -8,6 +8,9 @@ import glob
 
 from .cmds.indexer import Indexer
 from .cmds.dump import Dumper
+from .cmds.compact import Compactor
+from .cmds.writer import TableLayout, parse_encodings
+from .cmds.dataset import Dataset
 
 # Required to suppress Hachoir warnings
 from hachoir.core import config as HachoirConfig
@@ -54,21 +57,76 @@ def cli4():
               "-s",
               is_flag=True,
               help="Do everything silent")          
+@click.option("--workers",
+              "-w",
+              default=1,
+              type=int,
+              help="Number of worker processes, each WARC file indexed by separate process. Default: 1")
+@click.option("--batch-size",
+              "-b",
+              default=50000,
+              type=int,
+              help="Number of rows per record batch and parquet row group. Default: 50000")
+@click.option("--split-size",
+              default=1024,
+              type=int,
+              help="With several workers gzipped WARC files larger than this size in megabytes split into parts indexed in parallel, 0 disables splitting. Default: 1024")
+@click.option("--sort-by",
+              default="",
+              help="Comma separated list of columns to sort records tables by, for example c_type,ext,url. Default: not sorted, records in WARC file order")
+@click.option("--row-group-size",
+              default=None,
+              type=int,
+              help="Number of rows per parquet row group. Default: same as batch size")
+@click.option("--compression-level",
+              default=3,
+              type=int,
+              help="Zstd compression level of parquet files. Default: 3")
+@click.option("--bloom-filters",
+              default="",
+              help="Comma separated list of columns to write bloom filters for, for example url,warc_id")
+@click.option("--encodings",
+              default="",
+              help="Comma separated list of column:ENCODING pairs, for example offset:DELTA_BINARY_PACKED,url:DELTA_BYTE_ARRAY")
+@click.option("--output-root",
+              default="data",
+              help="Root directory of Parquet files. Default: data")
+@click.option("--partitioned",
+              is_flag=True,
+              help="Write Parquet files as hive partitioned dataset like type=records/crawl=<crawl>/c_type_group=<group>/<name>.parquet")
+@click.option("--crawl",
+              default=None,
+              help="Crawl name used as crawl partition of partitioned dataset, WARC files of one crawl share partition. Default: name of WARC file directory")
+@click.option("--from-cdx",
+              is_flag=True,
+              help="Write records tables from CDX or CDXJ files with the same names as WARC files without reading WARC files. Headers tables added when indexed without this option")
+@click.option("--fast-scan",
+              is_flag=True,
+              help="Read only headers of records and skip payloads. Uncompressed WARC files and gzipped WARC files with CDX file supported, others read as usual")
+@click.option("--checkpoint-size",
+              default=1024,
+              type=int,
+              help="WARC files larger than this size in megabytes indexed by chunks of this size, interrupted indexing continues from last indexed chunk. 0 disables checkpoints")
+@click.option("--checksum",
+              is_flag=True,
+              help="Compare checksums of first and last blocks of WARC files with changed modification time, files with the same checksum not reindexed")
 @click.option("--verbose",
               "-v",
               is_flag=True,
               help="Verbose output. Print additional info")          
-def warcindex(inputfile:str, tofile:str, tables:str, update:bool=True, rescan:bool=False, silent:bool=False, verbose:bool=True):
+def warcindex(inputfile:str, tofile:str, tables:str, update:bool=True, rescan:bool=False, silent:bool=False, workers:int=1, batch_size:int=50000, split_size:int=1024, sort_by:str='', row_group_size:int=None, compression_level:int=3, bloom_filters:str='', encodings:str='', output_root:str='data', partitioned:bool=False, crawl:str=None, from_cdx:bool=False, fast_scan:bool=False, checkpoint_size:int=1024, checksum:bool=False, verbose:bool=True):
     """Builds WARC file index as DuckDB database file and accompanied Parquet files"""
     if verbose:
         enableVerbose()
     if os.path.exists(tofile) and not update:
         print(f'Output database {tofile} already exists. Please choose another file name or use update option')
         return
-    acmd = Indexer()
+    acmd = Indexer(Dataset(output_root, partitioned=partitioned, crawl=crawl))
     all_tables = ['records', 'headers']
     files = glob.glob(inputfile.strip("'"))    
-    acmd.index_records(files, tofile, all_tables, rescan=rescan, silent=silent)
+    layout = TableLayout(sort_by=[x for x in sort_by.split(',') if x], row_group_size=row_group_size, compression_level=compression_level,
+                         bloom_filters=[x for x in bloom_filters.split(',') if x], encodings=parse_encodings(encodings))
+    acmd.index_records(files, tofile, all_tables, rescan=rescan, silent=silent, workers=workers, batch_size=batch_size, split_size=split_size * 1024 * 1024, layout=layout, checksum=checksum, checkpoint_size=checkpoint_size * 1024 * 1024, fast_scan=fast_scan, from_cdx=from_cdx)
     pass
 
 
@@ -97,24 +155,52 @@ def cli9():
               "-s",
               is_flag=True,
               help="Do everything silent")          
+@click.option("--workers",
+              "-w",
+              default=1,
+              type=int,
+              help="Number of worker processes to extract metadata. Default: 1")
+@click.option("--spill-size",
+              default=32,
+              type=int,
+              help="Payloads larger than this size in megabytes are written to temporary file instead of memory. Default: 32")
+@click.option("--links-engine",
+              default="lxml",
+              type=click.Choice(['lxml', 'bs4']),
+              help="Links extraction engine: lxml (streaming parser) or bs4 (BeautifulSoup). Default: lxml")
+@click.option("--output-root",
+              default="data",
+              help="Root directory of Parquet files. Default: data")
+@click.option("--partitioned",
+              is_flag=True,
+              help="Write Parquet files as hive partitioned dataset like type=records/crawl=<crawl>/c_type_group=<group>/<name>.parquet")
+@click.option("--crawl",
+              default=None,
+              help="Crawl name used as crawl partition of partitioned dataset, WARC files of one crawl share partition. Default: name of WARC file directory")
+@click.option("--cache-dir",
+              default=None,
+              help="Directory of payloads cache shared by get, dump and index-content commands. Cached payloads not extracted again. Default: no cache")
+@click.option("--cache-size",
+              default=1024,
+              type=int,
+              help="Cache size in megabytes, least recently used payloads removed when cache is larger. Default: 1024")
 @click.option("--verbose",
               "-v",
               is_flag=True,
               help="Verbose output. Print additional info")          
-def index_content(inputfiles:str, tofile:str, tables:str, update:bool=True, rescan:bool=True, silent:bool=False, verbose:bool=True):
+def index_content(inputfiles:str, tofile:str, tables:str, update:bool=True, rescan:bool=True, silent:bool=False, workers:int=1, spill_size:int=32, links_engine:str='lxml', output_root:str='data', partitioned:bool=False, crawl:str=None, cache_dir:str=None, cache_size:int=1024, verbose:bool=True):
     """Builds WARC file index as DuckDB database file"""
     if verbose:
         enableVerbose()
     if os.path.exists(tofile) and not update:
         print(f'Output database {tofile} already exists. Please choose another file name or use update option')
         return
-    acmd = Indexer()
-    if inputfiles is not None and len(inputfiles) == 0:
+    acmd = Indexer(Dataset(output_root, partitioned=partitioned, crawl=crawl))
+    if inputfiles is not None and len(inputfiles) > 0:
         files = glob.glob(inputfiles)
     else:
         files = None
-    for table in tables.split(','):
-        acmd.index_by_table_type(files, tofile, table_type=table, rescan=rescan, silent=silent)
+    acmd.index_content(files, tofile, table_types=tables.split(','), rescan=rescan, silent=silent, workers=workers, spill_size=spill_size * 1024 * 1024, links_engine=links_engine, cache_dir=cache_dir, cache_size=cache_size * 1024 * 1024)
     pass
 
 @click.group()
@@ -125,7 +211,7 @@ def cli5():
 @click.option("--mode",
               "-m",
               default="mimes",
-              help="Analysis mode: mimes, exts. Default: mimes")
+              help="Analysis mode: mimes, exts, statuses, hosts, dates. Default: mimes")
 @click.option("--dbfile",
               "-i",
               default="warcindex.db",
@@ -135,7 +221,7 @@ def cli5():
               is_flag=True,
               help="Verbose output. Print additional info")
 def stats(mode, dbfile, verbose):
-    """Generates mime or exts statistics"""
+    """Generates mime, exts, status code, host or date statistics"""
     if verbose:
         enableVerbose()
     acmd = Indexer()
@@ -202,12 +288,36 @@ def cli7():
               "-o",
               default='dump',
               help="Output dir. Default: dump")
-def dump(mimes, exts, query, verbose, output):
+@click.option("--workers",
+              "-w",
+              default=4,
+              type=int,
+              help="Number of threads extracting files. Default: 4")
+@click.option("--shard-format",
+              "-f",
+              default=None,
+              type=click.Choice(['tar', 'zip', 'warc']),
+              help="Write files into tar or zip shards or original records into gzipped WARC shards instead of separate files")
+@click.option("--shard-size",
+              default=1024,
+              type=int,
+              help="Shard size in megabytes, next shard started when current one reaches it. Default: 1024")
+@click.option("--raw",
+              is_flag=True,
+              help="Write records as stored in WARC files, gzipped records written as gzip members")
+@click.option("--cache-dir",
+              default=None,
+              help="Directory of payloads cache shared by get, dump and index-content commands. Cached payloads not extracted again. Default: no cache")
+@click.option("--cache-size",
+              default=1024,
+              type=int,
+              help="Cache size in megabytes, least recently used payloads removed when cache is larger. Default: 1024")
+def dump(mimes, exts, query, verbose, output, workers, shard_format, shard_size, raw, cache_dir, cache_size):
     """Dumps content by query"""
     if verbose:
         enableVerbose()
     acmd = Dumper()
-    acmd.dump(mimes=mimes, exts=exts, query=query, output=output)
+    acmd.dump(mimes=mimes, exts=exts, query=query, output=output, workers=workers, shard_format=shard_format, shard_size=shard_size * 1024 * 1024, raw=raw, cache_dir=cache_dir, cache_size=cache_size * 1024 * 1024)
     pass
 
 
@@ -277,7 +387,17 @@ def cli2():
               "-v",
               is_flag=True,
               help="Verbose output. Print additional info")          
-def get(fileid:str, dbfile:str, output:str=None, silent:bool=False, verbose:bool=True):
+@click.option("--raw",
+              is_flag=True,
+              help="Write record as stored in WARC file, gzipped records written as gzip members")
+@click.option("--cache-dir",
+              default=None,
+              help="Directory of payloads cache shared by get, dump and index-content commands. Cached payloads not extracted again. Default: no cache")
+@click.option("--cache-size",
+              default=1024,
+              type=int,
+              help="Cache size in megabytes, least recently used payloads removed when cache is larger. Default: 1024")
+def get(fileid:str, dbfile:str, output:str=None, silent:bool=False, verbose:bool=True, raw:bool=False, cache_dir:str=None, cache_size:int=1024):
     """Extract selected file/url by warc_id or url"""
     if verbose:
         enableVerbose()
@@ -285,11 +405,70 @@ def get(fileid:str, dbfile:str, output:str=None, silent:bool=False, verbose:bool
         print(f'Database {db} not found. Please index WARC files before dumping')
         return
     acmd = Dumper()
-    acmd.get_file(fileid, dbfile, output=output, silent=silent)
+    acmd.get_file(fileid, dbfile, output=output, silent=silent, raw=raw, cache_dir=cache_dir, cache_size=cache_size * 1024 * 1024)
+    pass
+
+
+@click.group()
+def cli3():
+    pass
+
+@cli3.command(name="compact")
+@click.option("--dbfile",
+              "-d",
+              default="warcindex.db",
+              help="Name of the db file. Default: warcindex.db")
+@click.option("--tables",
+              "-t",
+              default="records,headers",
+              help="Comma separated list of tables to compact. Default: records,headers")
+@click.option("--target-size",
+              default=512,
+              type=int,
+              help="Target size of compacted files in megabytes. Default: 512")
+@click.option("--sort-by",
+              default="source,offset",
+              help="Comma separated list of columns to sort compacted files by, missing columns ignored. Default: source,offset")
+@click.option("--row-group-size",
+              default=None,
+              type=int,
+              help="Number of rows per parquet row group. Default: 50000")
+@click.option("--compression-level",
+              default=3,
+              type=int,
+              help="Zstd compression level of parquet files. Default: 3")
+@click.option("--bloom-filters",
+              default="",
+              help="Comma separated list of columns to write bloom filters for, for example url,warc_id")
+@click.option("--output-root",
+              default="data",
+              help="Root directory of Parquet files, compacted files written to 'compacted' subdirectory. Default: data")
+@click.option("--full",
+              is_flag=True,
+              help="Recompact all files including already compacted ones. By default only new files and small compacted files merged")
+@click.option("--silent",
+              "-s",
+              is_flag=True,
+              help="Do everything silent")
+@click.option("--verbose",
+              "-v",
+              is_flag=True,
+              help="Verbose output. Print additional info")
+def compact(dbfile:str, tables:str, target_size:int=512, sort_by:str='source,offset', row_group_size:int=None, compression_level:int=3, bloom_filters:str='', output_root:str='data', full:bool=False, silent:bool=False, verbose:bool=True):
+    """Merges small Parquet files of indexed WARC files into larger sorted files"""
+    if verbose:
+        enableVerbose()
+    if not os.path.exists(dbfile):
+        print(f'Database {dbfile} not found. Please index WARC files before compacting')
+        return
+    layout = TableLayout(sort_by=[x for x in sort_by.split(',') if x], row_group_size=row_group_size, compression_level=compression_level,
+                         bloom_filters=[x for x in bloom_filters.split(',') if x])
+    acmd = Compactor(output_root)
+    acmd.compact(dbfile, table_types=tables.split(','), target_size=target_size * 1024 * 1024, layout=layout, full=full, silent=silent)
     pass
 
 
-cli = click.CommandCollection(sources=[cli1, cli2, cli4, cli5, cli6, cli7, cli9])
+cli = click.CommandCollection(sources=[cli1, cli2, cli3, cli4, cli5, cli6, cli7, cli9])
 
 # if __name__ == '__main__':
 #    cli()
@@ -41,7 +41,8 @@ install_requires = [
     'rich',
     'lxml',
     'hachoir',
-    'sqlalchemy'
+    'sqlalchemy',
+    'tldextract'
 ]
 
 
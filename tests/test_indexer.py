@@ -0,0 +1,155 @@
+import io
+
+import pytest
+import pyarrow.parquet as pq
+from warcio.archiveiterator import ArchiveIterator
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+
+from metawarc.cmds.dataset import Dataset
+from metawarc.cmds.indexer import Indexer, load_checkpoint, save_checkpoint
+from metawarc.cmds.scanner import split_ranges
+
+
+NUM_PAGES = 30
+
+
+def build_warc(filename:str, gzip:bool, num_pages:int=NUM_PAGES):
+    """Writes WARC file with warcinfo, request, response and resource records of different sizes"""
+    with open(filename, 'wb') as fh:
+        writer = WARCWriter(fh, gzip=gzip)
+        writer.write_record(writer.create_warcinfo_record(filename, {'software' : 'metawarc tests'}))
+        for num in range(num_pages):
+            url = 'http://example.com/dir/page%d.html' % num
+            payload = (b'<html><body><a href="/page%d.html">next</a></body></html>' % (num + 1)) * (num * 7 + 1)
+            http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html; charset=utf-8'), ('Content-Length', str(len(payload)))], protocol='HTTP/1.1')
+            request_headers = StatusAndHeaders('GET /dir/page%d.html HTTP/1.1' % num, [('Host', 'example.com')], is_http_request=True)
+            writer.write_record(writer.create_warc_record(url, 'request', http_headers=request_headers))
+            writer.write_record(writer.create_warc_record(url, 'response', payload=io.BytesIO(payload), http_headers=http_headers))
+            if num % 5 == 0:
+                writer.write_record(writer.create_warc_record(url.replace('.html', '.txt'), 'resource', payload=io.BytesIO(b'text ' * num), warc_content_type='text/plain'))
+
+
+def build_cdx(filename:str, cdx_filename:str):
+    """Writes CDX file with response records of WARC file"""
+    with open(filename, 'rb') as fh, open(cdx_filename, 'w', encoding='utf8') as out:
+        out.write(' CDX N b a m s k r M S V g\n')
+        iterator = ArchiveIterator(fh)
+        for record in iterator:
+            if record.rec_type != 'response':
+                continue
+            url = record.rec_headers.get_header('WARC-Target-URI')
+            mime = record.http_headers.get_header('Content-Type').split(';')[0]
+            record.content_stream().read()
+            offset, length = iterator.get_record_offset(), iterator.get_record_length()
+            out.write('%s 20240101000000 %s %s 200 - - - %d %d %s\n' % (url, url, mime, length, offset, filename))
+
+
+def table_locations(path:str):
+    """Returns sorted list of offsets and lengths of records table"""
+    table = pq.read_table(path, columns=['offset', 'length'])
+    return sorted(zip(table.column('offset').to_pylist(), table.column('length').to_pylist()))
+
+
+@pytest.fixture(params=['test.warc', 'test.warc.gz'])
+def warcfile(request, tmp_path):
+    filename = str(tmp_path / request.param)
+    build_warc(filename, gzip=filename.endswith('.gz'))
+    return filename
+
+
+def index_default(warcfile:str, root:str):
+    indexer = Indexer(Dataset(root))
+    indexer.index_file(warcfile, ['records', 'headers'], rescan=True, silent=True, checkpoint_size=0)
+    return table_locations(indexer.dataset.table_path(warcfile, 'records'))
+
+
+def test_default_index(warcfile, tmp_path):
+    locations = index_default(warcfile, str(tmp_path / 'default'))
+    assert len(locations) == NUM_PAGES
+    assert len(set([offset for offset, length in locations])) == NUM_PAGES
+
+
+def test_fast_scan(warcfile, tmp_path):
+    expected = index_default(warcfile, str(tmp_path / 'default'))
+    indexer = Indexer(Dataset(str(tmp_path / 'fast')))
+    indexer.index_file(warcfile, ['records', 'headers'], rescan=True, silent=True, checkpoint_size=0, fast_scan=True)
+    assert table_locations(indexer.dataset.table_path(warcfile, 'records')) == expected
+
+
+def test_fast_scan_with_cdx(tmp_path):
+    warcfile = str(tmp_path / 'test.warc.gz')
+    build_warc(warcfile, gzip=True)
+    expected = index_default(warcfile, str(tmp_path / 'default'))
+    build_cdx(warcfile, str(tmp_path / 'test.cdx'))
+    indexer = Indexer(Dataset(str(tmp_path / 'fast')))
+    indexer.index_file(warcfile, ['records', 'headers'], rescan=True, silent=True, checkpoint_size=0, fast_scan=True)
+    assert table_locations(indexer.dataset.table_path(warcfile, 'records')) == expected
+
+
+@pytest.mark.parametrize('fast_scan', [False, True])
+def test_split_ranges(tmp_path, fast_scan):
+    warcfile = str(tmp_path / 'test.warc.gz')
+    build_warc(warcfile, gzip=True)
+    expected = index_default(warcfile, str(tmp_path / 'default'))
+    ranges = split_ranges(warcfile, 4)
+    assert len(ranges) > 1
+    indexer = Indexer(Dataset(str(tmp_path / 'split')))
+    locations = []
+    for part, (start, end) in enumerate(ranges):
+        paths = indexer.index_range(warcfile, ['records'], start, end, part, fast_scan=fast_scan)
+        locations.extend(table_locations(paths['records']))
+    assert sorted(locations) == expected
+
+
+def test_checkpoint_resume(warcfile, tmp_path, monkeypatch):
+    expected = index_default(warcfile, str(tmp_path / 'default'))
+    indexer = Indexer(Dataset(str(tmp_path / 'checkpoints')))
+    iterate_records = Indexer.iterate_records
+    calls = []
+
+    def interrupted(self, *args, **kwargs):
+        if len(calls) == 2:
+            raise KeyboardInterrupt()
+        calls.append(kwargs.get('start'))
+        return iterate_records(self, *args, **kwargs)
+
+    monkeypatch.setattr(Indexer, 'iterate_records', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        indexer.index_file(warcfile, ['records', 'headers'], rescan=True, silent=True, checkpoint_size=4096)
+    monkeypatch.setattr(Indexer, 'iterate_records', iterate_records)
+
+    checkpoint = indexer.dataset.checkpoint_path(warcfile)
+    with open(checkpoint, 'r', encoding='utf8') as f:
+        assert '"parts": 2' in f.read()
+    indexer.index_file(warcfile, ['records', 'headers'], rescan=True, silent=True, checkpoint_size=4096)
+    assert table_locations(indexer.dataset.table_path(warcfile, 'records')) == expected
+
+
+def test_from_cdx(tmp_path):
+    warcfile = str(tmp_path / 'test.warc.gz')
+    build_warc(warcfile, gzip=True)
+    expected = index_default(warcfile, str(tmp_path / 'default'))
+    build_cdx(warcfile, str(tmp_path / 'test.cdx'))
+    indexer = Indexer(Dataset(str(tmp_path / 'cdx')))
+    assert indexer.index_cdx(warcfile, silent=True) is not None
+    assert table_locations(indexer.dataset.table_path(warcfile, 'records')) == expected
+
+
+def test_same_named_warc_files(tmp_path):
+    warcfiles = [str(tmp_path / 'c1' / 'x.warc.gz'), str(tmp_path / 'c2' / 'x.warc.gz')]
+    for num, warcfile in enumerate(warcfiles):
+        (tmp_path / ('c%d' % (num + 1))).mkdir()
+        build_warc(warcfile, gzip=True, num_pages=NUM_PAGES + num * 10)
+    indexer = Indexer(Dataset(str(tmp_path / 'data'), partitioned=True))
+    assert indexer.dataset.part_path(warcfiles[0], 'records', 0) != indexer.dataset.part_path(warcfiles[1], 'records', 0)
+    assert indexer.dataset.checkpoint_path(warcfiles[0]) != indexer.dataset.checkpoint_path(warcfiles[1])
+    for warcfile in warcfiles:
+        paths = indexer.index_range(warcfile, ['records'], 0, None, 0)
+        sources = pq.read_table(paths['records'], columns=['source']).column('source').to_pylist()
+        assert set(sources) == {warcfile}
+
+    checkpoint = indexer.dataset.checkpoint_path(warcfiles[0])
+    save_checkpoint(checkpoint, {'filename' : warcfiles[1], 'offset' : 0, 'parts' : 0})
+    assert load_checkpoint(checkpoint, warcfiles[0]) is None
+    assert load_checkpoint(checkpoint, warcfiles[1]) is not None